@@ -0,0 +1,28 @@
+"""
+Shared tooling for the cascade analyses
+
+The analysis scripts in each subfolder (HIV South Africa, T2DM Poltava, Pakistan vaccines,
+hypertension Malawi) import this module for the parts of the workflow that are common to all of them.
+Scripts are run from inside their own folder, so they add the repository root to ``sys.path``
+before importing ``cascade_analyses``.
+
+"""
+
+from .system import logger
+from .build import *
+from .stages import *
+from .scenarios import *
+from .parallel import *
+from .memoize import *
+from .coverage import *
+from .results import *
+from .retention import *
+from .years import *
+from .indicators import *
+from .export import *
+from .optimization import *
+from .plotting import *
+from .uncertainty import *
+from .warmstart import *
+from .calibration import *
+from .instrument import *
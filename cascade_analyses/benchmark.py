@@ -0,0 +1,296 @@
+"""
+Benchmarks of the bundled analyses
+
+Each analysis is built from the framework, databook, progbook and simulation settings in its configuration file
+(see :mod:`cascade_analyses.config`), and the following steps are timed:
+
+- ``framework`` - load the framework spreadsheet
+- ``databook`` - create the project and load the databook
+- ``parset`` - make the default parset and apply the analysis' simulation settings
+- ``runsim`` - run the parset without programs
+- ``progbook`` - load the progbook
+- ``runsim_programs`` - run the parset with the default program instructions
+- ``optimize`` - a fixed number of ASD iterations, reallocating the default budget to maximize the final cascade stage
+
+The sequence is repeated ``repeats`` times from scratch, followed by one more pass with ``tracemalloc``
+enabled to record the peak memory allocated during each step (kept separate so that tracing does not
+affect the timings). Each analysis runs in its own freshly spawned process, so that the maximum resident
+set size of the process is also a per-analysis measurement. If a step fails (e.g. because a model
+is not compatible with the installed version of Atomica), the error is recorded and the steps that
+depend on it are skipped.
+
+Results are written to a JSON file, which can be compared against an earlier run to catch regressions.
+Run from the repository root::
+
+    python -m cascade_analyses.benchmark --output benchmarks.json
+    python -m cascade_analyses.benchmark --output new.json --compare benchmarks.json
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tracemalloc
+
+import numpy as np
+import atomica as at
+import sciris as sc
+
+from .config import load_config
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows, in which case the maximum resident set size is not reported
+
+__all__ = ["CONFIGS", "ANALYSES", "STEPS", "benchmark_analysis", "run_benchmarks", "summarize", "compare_benchmarks"]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # Repository root, containing the analysis folders
+
+#: Configuration file of each bundled analysis, relative to the repository root
+CONFIGS = sc.odict(
+    [
+        ("hiv-southafrica", "hiv-southafrica/hiv_southafrica.json"),
+        ("t2dm-poltava", "t2dm-poltava/t2dm_poltava.json"),
+        ("pakistan-vaccines", "pakistan-vaccines/pakistan_vaccines.json"),
+        ("hypertension-malawi", "hypertension-malawi/hypertension_malawi.json"),
+    ]
+)
+
+
+def _load_analysis(path: str) -> sc.objdict:
+    # Read a configuration file, adding the year that program spending starts (from the 'runsim_programs' section if there is one)
+    analysis = load_config(os.path.join(ROOT, path))
+    analysis.start_year = analysis.runsim_programs["start_year"] if analysis.runsim_programs else analysis.settings["sim_start"]
+    return analysis
+
+
+#: Inputs and settings for each bundled analysis, read from its configuration file (see :mod:`cascade_analyses.config`)
+ANALYSES = sc.odict([(name, _load_analysis(path)) for name, path in CONFIGS.items()])
+
+STEPS = ["framework", "databook", "parset", "runsim", "progbook", "runsim_programs", "optimize"]  #: Benchmarked steps, in the order they are run
+
+
+def _run_step(step: str, state: sc.objdict, analysis: sc.objdict, folder: str, optim_iters: int) -> None:
+    # Run one step, storing its outputs in state
+    if step == "framework":
+        state.F = at.ProjectFramework(os.path.join(folder, analysis.framework))
+    elif step == "databook":
+        state.P = at.Project(framework=state.F, do_run=False)
+        state.P.load_databook(databook_path=os.path.join(folder, analysis.databook), make_default_parset=False, do_run=False)
+    elif step == "parset":
+        state.P.make_parset(name="default")
+        state.P.settings.update_time_vector(start=analysis.settings["sim_start"], end=analysis.settings["sim_end"], dt=analysis.settings["sim_dt"])
+    elif step == "runsim":
+        state.P.run_sim(parset="default")
+    elif step == "progbook":
+        state.P.load_progbook(os.path.join(folder, analysis.progbook))
+    elif step == "runsim_programs":
+        state.instructions = at.ProgramInstructions(start_year=analysis.start_year, alloc=state.P.progsets[0])
+        state.P.run_sim(parset="default", progset=state.P.progsets[0], progset_instructions=state.instructions)
+    elif step == "optimize":
+        progset = state.P.progsets[0]
+        end_year = analysis.settings["sim_end"]
+        adjustments = [at.SpendingAdjustment(x, analysis.start_year, "rel", 0.0, 2.0) for x in progset.programs.keys()]
+        measurables = at.MaximizeCascadeStage(list(state.F.cascades.keys())[0], [end_year])
+        optimization = at.Optimization(name="benchmark", adjustments=adjustments, measurables=measurables, constraints=at.TotalSpendConstraint())
+        optim_args = {"maxiters": optim_iters, "maxtime": None, "abstol": 0, "reltol": 0, "stalliters": optim_iters + 1, "randseed": 1, "verbose": 0}  # Always run exactly optim_iters iterations
+        at.optimize(state.P, optimization, parset=state.P.parsets["default"], progset=progset, instructions=state.instructions, optim_args=optim_args)
+
+
+def _run_pass(name: str, analysis: sc.objdict, optim_iters: int, trace: bool) -> sc.odict:
+    # Run all steps once, returning the time (or peak memory) for each step, or the exception raised
+    folder = analysis.folder
+    state = sc.objdict()
+    out = sc.odict()
+    failed = False
+    for step in STEPS:
+        if failed:
+            out[step] = None
+            continue
+        if trace:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        tm = sc.tic()
+        try:
+            _run_step(step, state, analysis, folder, optim_iters)
+        except Exception as E:
+            out[step] = E
+            failed = True
+            continue
+        out[step] = (tracemalloc.get_traced_memory()[1] - baseline) / 1e6 if trace else sc.toc(tm, output=True)
+    return out
+
+
+def benchmark_analysis(name: str, repeats: int = 3, optim_iters: int = 10, memory: bool = True) -> sc.odict:
+    """
+    Benchmark one analysis in the current process
+
+    :param name: Name of an analysis in :data:`ANALYSES`
+    :param repeats: Number of timed passes over all steps
+    :param optim_iters: Number of ASD iterations in the ``optimize`` step
+    :param memory: If True, run one more pass to record the peak memory allocated in each step
+    :return: An ``sc.odict`` keyed by step, with dicts containing ``status`` ('ok', 'failed' or 'skipped'), ``times`` (seconds, one per pass),
+             ``min``, ``median``, ``peak_mb`` and ``error``
+
+    """
+
+    if name not in ANALYSES:
+        raise Exception(f'Unknown analysis "{name}" - must be one of {ANALYSES.keys()}')
+    analysis = ANALYSES[name]
+
+    out = sc.odict([(step, {"status": "ok", "times": [], "min": None, "median": None, "peak_mb": None, "error": None}) for step in STEPS])
+    for _ in range(repeats):
+        for step, value in _run_pass(name, analysis, optim_iters, trace=False).items():
+            if value is None:
+                out[step]["status"] = "skipped"
+            elif isinstance(value, Exception):
+                out[step]["status"] = "failed"
+                out[step]["error"] = f"{type(value).__name__}: {value}"
+            else:
+                out[step]["times"].append(value)
+        if any(x["status"] != "ok" for x in out.values()):
+            break  # Failures are deterministic, so there is no need to repeat them
+
+    if memory:
+        tracemalloc.start()
+        try:
+            for step, value in _run_pass(name, analysis, optim_iters, trace=True).items():
+                if value is not None and not isinstance(value, Exception):
+                    out[step]["peak_mb"] = value
+        finally:
+            tracemalloc.stop()
+
+    for entry in out.values():
+        if entry["times"]:
+            entry["min"] = float(np.min(entry["times"]))
+            entry["median"] = float(np.median(entry["times"]))
+    return out
+
+
+def _benchmark_process(name: str, repeats: int, optim_iters: int, memory: bool) -> dict:
+    # Benchmark an analysis in a worker process, and add the maximum resident set size of the process
+    steps = benchmark_analysis(name, repeats=repeats, optim_iters=optim_iters, memory=memory)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1e6 if sys.platform == "darwin" else 1e3) if resource is not None else None  # Bytes on macOS, kB on Linux
+    return {"steps": dict(steps), "maxrss_mb": maxrss}
+
+
+def run_benchmarks(analyses: list = None, repeats: int = 3, optim_iters: int = 10, memory: bool = True, isolate: bool = True) -> dict:
+    """
+    Benchmark several analyses
+
+    :param analyses: List of analysis names. By default, all of :data:`ANALYSES`
+    :param repeats: Number of timed passes over all steps
+    :param optim_iters: Number of ASD iterations in the ``optimize`` step
+    :param memory: If True, record the peak memory allocated in each step
+    :param isolate: If True, run each analysis in its own spawned process
+    :return: A dict with the ``environment`` (package versions and machine details), the ``settings`` used, and the results for each analysis
+
+    """
+
+    analyses = sc.promotetolist(analyses) if analyses is not None else ANALYSES.keys()
+    out = {
+        "environment": {"atomica": at.__version__, "sciris": sc.__version__, "numpy": np.__version__, "python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor(), "cpus": os.cpu_count(), "date": str(sc.now())},
+        "settings": {"repeats": repeats, "optim_iters": optim_iters, "memory": memory, "isolate": isolate},
+        "analyses": {},
+    }
+
+    for name in analyses:
+        tm = sc.tic()
+        if isolate:
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                out["analyses"][name] = pool.apply(_benchmark_process, (name, repeats, optim_iters, memory))
+        else:
+            out["analyses"][name] = {"steps": dict(benchmark_analysis(name, repeats=repeats, optim_iters=optim_iters, memory=memory)), "maxrss_mb": None}
+        print(f'Benchmarked "{name}" in {sc.toc(tm, output=True):.1f}s')
+    return out
+
+
+def _fmt(x, spec: str) -> str:
+    # Format a value that may be missing
+    return format(x, spec) if x is not None else "-"
+
+
+def summarize(benchmarks: dict) -> str:
+    """
+    Return a text table of benchmark results
+
+    :param benchmarks: The output of :func:`run_benchmarks`
+    :return: A string with one line per analysis and step
+
+    """
+
+    env = benchmarks["environment"]
+    lines = [f"Atomica {env['atomica']}, sciris {env['sciris']}, numpy {env['numpy']}, Python {env['python']} on {env['platform']} ({env['cpus']} CPUs)", ""]
+    lines.append(f"{'Analysis':<22}{'Step':<18}{'Median (s)':>12}{'Min (s)':>12}{'Peak (MB)':>12}  Status")
+    for name, analysis in benchmarks["analyses"].items():
+        for step, entry in analysis["steps"].items():
+            status = entry["status"] if entry["status"] != "failed" else "failed - " + " ".join(entry["error"].split())[:80]
+            lines.append(f"{name:<22}{step:<18}{_fmt(entry['median'], '.4f'):>12}{_fmt(entry['min'], '.4f'):>12}{_fmt(entry['peak_mb'], '.1f'):>12}  {status}")
+        if analysis.get("maxrss_mb") is not None:
+            lines.append(f"{name:<22}{'max RSS':<18}{'':>24}{analysis['maxrss_mb']:>12.1f}")
+    return "\n".join(lines)
+
+
+def compare_benchmarks(baseline: dict, current: dict, threshold: float = 0.2) -> list:
+    """
+    Find steps that have become slower or stopped working
+
+    :param baseline: The output of :func:`run_benchmarks` (or the loaded JSON file) for the reference run
+    :param current: The output of :func:`run_benchmarks` for the new run
+    :param threshold: Relative increase in the minimum time above which a step is reported as a regression
+    :return: List of dicts with ``analysis``, ``step``, ``baseline`` and ``current`` minimum times, ``ratio``, and ``reason``
+
+    """
+
+    regressions = []
+    for name, analysis in current["analyses"].items():
+        if name not in baseline["analyses"]:
+            continue
+        for step, entry in analysis["steps"].items():
+            ref = baseline["analyses"][name]["steps"].get(step)
+            if ref is None or ref["status"] != "ok":
+                continue
+            if entry["status"] != "ok":
+                regressions.append({"analysis": name, "step": step, "baseline": ref["min"], "current": None, "ratio": None, "reason": entry["status"]})
+            elif entry["min"] > ref["min"] * (1 + threshold):
+                regressions.append({"analysis": name, "step": step, "baseline": ref["min"], "current": entry["min"], "ratio": entry["min"] / ref["min"], "reason": "slower"})
+    return regressions
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the bundled cascade analyses")
+    parser.add_argument("analyses", nargs="*", help=f"Analyses to benchmark (default: all of {', '.join(ANALYSES.keys())})")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of timed passes over all steps")
+    parser.add_argument("--optim-iters", type=int, default=10, help="Number of ASD iterations in the optimize step")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the pass that records peak memory")
+    parser.add_argument("--no-isolate", action="store_true", help="Run all analyses in this process instead of a new process for each")
+    parser.add_argument("--output", default="benchmarks.json", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON file from an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative slowdown reported as a regression by --compare")
+    args = parser.parse_args(argv)
+
+    benchmarks = run_benchmarks(args.analyses or None, repeats=args.repeats, optim_iters=args.optim_iters, memory=not args.no_memory, isolate=not args.no_isolate)
+    with open(args.output, "w") as f:
+        json.dump(benchmarks, f, indent=2)
+    print(summarize(benchmarks))
+    print(f'\nWrote "{args.output}"')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_benchmarks(baseline, benchmarks, threshold=args.threshold)
+        print(f'\nComparison with "{args.compare}" (atomica {baseline["environment"]["atomica"]}):')
+        for x in regressions:
+            print(f"  {x['analysis']} {x['step']}: " + (f"{x['baseline']:.4f}s -> {x['current']:.4f}s ({x['ratio']:.2f}x)" if x["reason"] == "slower" else f"now {x['reason']}"))
+        if not regressions:
+            print("  No regressions")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
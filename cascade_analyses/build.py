@@ -0,0 +1,211 @@
+"""
+Cached, content-addressed project build
+
+Building a :class:`atomica.Project` from its spreadsheets means parsing the framework, the databook
+and the program book every time a script is run. This module splits that build into stages
+('framework', 'databook', 'parset', 'progbook') and stores the object produced by each stage on local disk
+under a key made from the content hashes of the files it depends on. On the next run, any stage
+whose inputs have not changed is loaded from disk and only the stages downstream of a modified
+file are rebuilt.
+
+Typical usage::
+
+    cache = ProjectCache('hiv_southafrica_framework.xlsx', 'hiv_southafrica_databook.xlsx', 'hiv_southafrica_progbook.xlsx', name="SA HIV project")
+    P = cache.get('progbook')  # Project with framework, data, default parset and default progset
+
+"""
+
+import hashlib
+import os
+import threading
+
+import atomica as at
+import sciris as sc
+
+from .system import logger
+
+__all__ = ["LEVELS", "file_hash", "ProjectCache"]
+
+#: Build stages, in order. Each stage depends on the files of all stages before it (except that
+#: the progbook does not depend on the parset)
+LEVELS = ["framework", "databook", "parset", "progbook"]
+
+_hashes = dict()  # Module-level memo of file hashes, keyed by (path, size, mtime)
+
+
+def file_hash(path: str, blocksize: int = 2**20) -> str:
+    """
+    Return the SHA-256 hash of a file's contents
+
+    Hashes are memoized against the file's size and modification time, so repeated calls
+    within the same session do not re-read unchanged files.
+
+    :param path: Path to the file
+    :param blocksize: Number of bytes to read at a time
+    :return: Hex digest string
+
+    """
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _hashes:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(blocksize), b""):
+                sha.update(block)
+        _hashes[memo_key] = sha.hexdigest()
+    return _hashes[memo_key]
+
+
+class ProjectCache:
+    """
+    Build a Project from spreadsheets, reusing previously built stages from disk
+
+    The cache stores one artifact per stage:
+
+    - 'framework' - the :class:`ProjectFramework`, keyed by the framework file
+    - 'databook' - the :class:`ProjectData`, keyed by the framework and databook files
+    - 'parset' - the :class:`ParameterSet`, keyed by the framework and databook files and the parset name
+    - 'progbook' - the :class:`ProgramSet`, keyed by the framework, databook and progbook files
+
+    The installed atomica version is included in every key, so upgrading atomica invalidates the cache.
+    The Project itself is assembled in memory from these artifacts and is built up progressively - calling
+    ``get('parset')`` followed by ``get('progbook')`` returns the same Project instance, with the progset
+    added by the second call.
+
+    :param framework: Path to the framework spreadsheet
+    :param databook: Path to the databook spreadsheet
+    :param progbook: Optionally specify path to the program book spreadsheet (required for the 'progbook' stage)
+    :param name: Name of the Project
+    :param parset_name: Name of the parset created in the 'parset' stage
+    :param progset_name: Name of the progset created in the 'progbook' stage
+    :param cache_dir: Folder to store artifacts in. By default, a ``.cache`` folder next to the framework file
+    :param rebuild: If True, ignore existing artifacts and rebuild (and re-save) every stage
+
+    """
+
+    def __init__(self, framework: str, databook: str, progbook: str = None, name: str = "default", parset_name: str = "default", progset_name: str = "default", cache_dir: str = None, rebuild: bool = False):
+        self.paths = {"framework": framework, "databook": databook, "progbook": progbook}
+        self.name = name
+        self.parset_name = parset_name
+        self.progset_name = progset_name
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(os.path.dirname(os.path.abspath(framework)), ".cache")
+        self.rebuild = rebuild
+        self.project = None  #: The Project assembled so far
+        self.status = sc.odict()  #: For each stage that has been materialized, whether it was 'loaded' from disk or 'built'
+        self.lock = threading.RLock()  #: Held while stages are added, so the cache can be shared between threads
+
+    def __repr__(self):
+        return sc.prepr(self)
+
+    def key(self, level: str) -> str:
+        """
+        Return the content-addressed key for a stage
+
+        :param level: One of :data:`LEVELS`
+        :return: Hex digest string identifying the inputs of the stage
+
+        """
+
+        if level == "framework":
+            parts = [at.__version__, file_hash(self.paths["framework"])]
+        elif level == "databook":
+            parts = [self.key("framework"), file_hash(self.paths["databook"])]
+        elif level == "parset":
+            parts = [self.key("databook"), self.parset_name]
+        elif level == "progbook":
+            if self.paths["progbook"] is None:
+                raise Exception("A program book was not provided to the cache, so the 'progbook' stage cannot be built")
+            parts = [self.key("databook"), file_hash(self.paths["progbook"]), self.progset_name]
+        else:
+            raise Exception(f'Unknown build stage "{level}" - must be one of {LEVELS}')
+        return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+    def artifact(self, level: str) -> str:
+        """
+        Return the path of the on-disk artifact for a stage
+
+        :param level: One of :data:`LEVELS`
+        :return: Path to the artifact (which may or may not exist yet)
+
+        """
+
+        return os.path.join(self.cache_dir, f"{level}_{self.key(level)[:20]}.obj")
+
+    def is_cached(self, level: str) -> bool:
+        """
+        Check whether a stage can be loaded from disk
+
+        :param level: One of :data:`LEVELS`
+        :return: True if an artifact matching the current input files exists
+
+        """
+
+        if self.rebuild and level not in self.status:
+            return False
+        return os.path.exists(self.artifact(level))
+
+    def get(self, level: str = "progbook") -> at.Project:
+        """
+        Return the Project built up to and including a stage
+
+        Stages that have already been added to the in-memory Project are not repeated. Otherwise,
+        the stage is loaded from disk if an artifact with a matching key exists, or else it
+        is built from the spreadsheet and the artifact is saved.
+
+        :param level: One of :data:`LEVELS`. For 'progbook', the parset stage is not required and is not built
+        :return: The Project instance
+
+        """
+
+        if level not in LEVELS:
+            raise Exception(f'Unknown build stage "{level}" - must be one of {LEVELS}')
+        required = ["framework", "databook", "progbook"] if level == "progbook" else LEVELS[: LEVELS.index(level) + 1]
+        with self.lock:
+            for lvl in required:
+                if lvl not in self.status:
+                    self._materialize(lvl)
+        return self.project
+
+    def _materialize(self, level: str) -> None:
+        # Add one stage to the in-memory project, loading its artifact if possible
+
+        fname = self.artifact(level)
+        if self.is_cached(level):
+            obj = sc.load(fname)
+            self.status[level] = "loaded"
+        else:
+            obj = self._build(level)
+            self._save(fname, obj)
+            self.status[level] = "built"
+        logger.info('Project cache: %s stage "%s"', self.status[level], level)
+
+        if level == "framework":
+            self.project = at.Project(name=self.name, framework=obj, do_run=False)
+        elif level == "databook":
+            self.project.load_databook(databook_path=obj, make_default_parset=False, do_run=False)
+        elif level == "parset":
+            self.project.parsets.append(obj)
+        elif level == "progbook":
+            self.project.progsets.append(obj)
+
+    def _build(self, level: str):
+        # Construct the object for a single stage from its spreadsheet
+        if level == "framework":
+            return at.ProjectFramework(self.paths["framework"])
+        elif level == "databook":
+            return at.ProjectData.from_spreadsheet(sc.Spreadsheet(self.paths["databook"]), self.project.framework)
+        elif level == "parset":
+            return at.ParameterSet(self.project.framework, self.project.data, self.parset_name)
+        elif level == "progbook":
+            progset = at.ProgramSet.from_spreadsheet(spreadsheet=sc.Spreadsheet(self.paths["progbook"]), framework=self.project.framework, data=self.project.data, name=self.progset_name)
+            progset.validate()
+            return progset
+
+    def _save(self, fname: str, obj) -> None:
+        # Write to a temporary file first so an interrupted save never leaves a truncated artifact behind
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = f"{fname}.{os.getpid()}.tmp"
+        sc.save(tmp, obj)
+        os.replace(tmp, fname)
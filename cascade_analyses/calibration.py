@@ -0,0 +1,348 @@
+"""
+Parallel automatic calibration with a resumable log
+
+``Project.calibrate()`` runs ASD serially, one simulation at a time, and starts from scratch every time it is
+called, so an interrupted five-minute calibration is lost. :func:`parallel_calibrate` adjusts the same
+y-factors to fit the same measurables with the same goodness-of-fit (Atomica's own calibration objective),
+but searches in batches: each iteration tries a step up and a step down for every adjustable, and evaluates
+all of those candidates at once on a process pool.
+
+Every evaluated point and its fit are appended to a :class:`CalibrationLog` as soon as they are computed.
+The search itself is deterministic, so running it again with the same log replays the earlier iterations
+from the logged values without simulating anything, and then carries on from where it stopped. This resumes
+an interrupted calibration, or extends a finished one by calling it again with a longer ``max_time``::
+
+    calibrated, diagnostics = parallel_calibrate(P, "default", log="calibration.jsonl", max_time=300, workers=4)
+    calibrated, diagnostics = parallel_calibrate(P, "default", log="calibration.jsonl", max_time=600, workers=4)  # Continues
+
+``max_time`` limits the time spent in each call. Replayed iterations take almost none of it.
+
+"""
+
+import json
+import os
+import time
+
+import atomica as at
+import atomica.calibration
+import numpy as np
+import sciris as sc
+
+from .memoize import quantize
+from .parallel import make_pool, worker_data, strip_results, n_workers
+from .system import logger
+
+__all__ = ["CalibrationLog", "parallel_calibrate"]
+
+
+class CalibrationLog:
+    """
+    Append-only log of calibration evaluations
+
+    The log is a text file with one JSON record per line. The first line describes the calibration (the
+    adjustables, measurables and bounds), and every other line holds one evaluated point and its objective.
+    Each record is flushed as it is written, so an interrupted calibration loses at most the evaluations
+    that were in progress. A partially written last line is ignored when the log is read.
+
+    :param path: File to read from (if it exists) and append to
+    :param digits: Number of significant figures used to match points against the log
+
+    """
+
+    def __init__(self, path: str, digits: int = 12):
+        self.path = path
+        self.digits = digits
+        self.header = None  #: The description of the calibration that the log was written for
+        self._values = dict()  # Maps quantized points to objective values
+        self._points = []  # Points in the order they were evaluated
+        self._file = None
+        if os.path.exists(path):
+            self._load()
+
+    def __repr__(self):
+        return f'<CalibrationLog "{self.path}" with {len(self)} evaluations>'
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, x):
+        return self._key(x) in self._values
+
+    def _key(self, x) -> bytes:
+        return quantize(x, self.digits).tobytes()
+
+    def _load(self) -> None:
+        with open(self.path) as f:
+            lines = f.read().split("\n")
+        for i, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if i < len(lines) - 1:
+                    raise Exception(f'Calibration log "{self.path}" is corrupted at line {i + 1}')
+                logger.warning('Ignoring the incomplete last line of calibration log "%s"', self.path)
+                continue
+            if "header" in record:
+                self.header = record["header"]
+            else:
+                self._store(record["x"], record["objective"])
+
+    def _store(self, x, objective: float) -> None:
+        key = self._key(x)
+        if key not in self._values:
+            self._points.append(np.array(x, dtype=float))
+        self._values[key] = objective
+
+    def _write(self, record: dict) -> None:
+        if self._file is None:
+            needs_newline = os.path.exists(self.path) and os.path.getsize(self.path) > 0
+            if needs_newline:
+                with open(self.path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    needs_newline = f.read(1) != b"\n"  # Terminate a partially written record before appending
+            self._file = open(self.path, "a")
+            if needs_newline:
+                self._file.write("\n")
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def start(self, header: dict) -> None:
+        """
+        Check that the log belongs to a calibration, or start a new log for it
+
+        :param header: Description of the calibration. If the log already has a header, it must be the same
+
+        """
+
+        header = json.loads(json.dumps(header))  # Normalize tuples and numbers to what is read back from the file
+        if self.header is None:
+            if len(self):
+                raise Exception(f'Calibration log "{self.path}" has evaluations but no header')
+            self.header = header
+            self._write({"header": header})
+        elif self.header != header:
+            raise Exception(f'Calibration log "{self.path}" was written for a different calibration (adjustables, measurables or bounds) - use a new log file')
+
+    def get(self, x, default=None) -> float:
+        """
+        Return the logged objective for a point
+
+        :param x: Array of y-factors
+        :param default: Value to return if the point has not been evaluated
+        :return: The objective value
+
+        """
+
+        return self._values.get(self._key(x), default)
+
+    def append(self, x, objective: float) -> None:
+        """
+        Record an evaluated point
+
+        :param x: Array of y-factors
+        :param objective: Objective value at ``x``
+
+        """
+
+        self._store(x, float(objective))
+        self._write({"x": [float(v) for v in x], "objective": float(objective)})
+
+    def best(self) -> tuple:
+        """
+        Return the best point evaluated so far
+
+        :return: Tuple with the array of y-factors and its objective, or ``(None, np.inf)`` if the log is empty
+
+        """
+
+        if not self._points:
+            return None, np.inf
+        values = [self.get(x) for x in self._points]
+        i = int(np.argmin(values))
+        return self._points[i], values[i]
+
+    def close(self) -> None:
+        """
+        Close the file
+
+        """
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _expand(project, parset, adjustables, measurables, default_min_scale, default_max_scale, default_weight, default_metric, time_period) -> tuple:
+    # Normalize the adjustables and measurables in the same way as Project.calibrate() and at.calibrate()
+    if adjustables is None:
+        fw = project.framework
+        adjustables = [x for df in [fw.pars, fw.comps, fw.characs] for x in df.index[~df["calibrate"].isnull()]]
+    if measurables is None:
+        measurables = list(project.framework.comps.index) + list(project.framework.characs.index)
+
+    pars_to_adjust = []
+    for adjustable in adjustables:
+        if sc.isstring(adjustable):
+            adjustable = (adjustable, None, default_min_scale, default_max_scale)
+        par_name, pop_name, scale_min, scale_max, *initial = adjustable
+        initial_value = initial[0] if initial else None
+        pops = parset.get_par(par_name).pops if pop_name is None else [pop_name]
+        pars_to_adjust += [(par_name, pop, scale_min, scale_max, initial_value) for pop in pops]
+
+    output_quantities = []
+    for measurable in measurables:
+        if sc.isstring(measurable):
+            measurable = (measurable, None, default_weight, default_metric)
+        var_label, pop_name, weight, metric = measurable[:4]
+        start_year, end_year = measurable[4:6] if len(measurable) == 6 else time_period
+        pops = project.data.pops.keys() if pop_name is None else [pop_name]
+        output_quantities += [(var_label, pop, weight, metric, start_year, end_year) for pop in pops]
+
+    # Set the initial y-factors, and keep only the adjustables that are allowed to vary
+    x0, xmin, xmax, adjusted = [], [], [], []
+    for par_name, pop_name, scale_min, scale_max, initial_value in pars_to_adjust:
+        par = parset.get_par(par_name)
+        if initial_value is None:
+            initial_value = np.clip(par.meta_y_factor if pop_name == "all" else par.y_factor[pop_name], scale_min, scale_max)
+        elif not scale_min <= initial_value <= scale_max:
+            raise Exception(f'Initial value {initial_value} for "{par_name}" in "{pop_name}" is outside its bounds ({scale_min}, {scale_max})')
+        atomica.calibration._update_parset(parset, [initial_value], [(par_name, pop_name)])
+        if scale_min != scale_max:
+            adjusted.append((par_name, pop_name))
+            x0.append(float(initial_value))
+            xmin.append(scale_min)
+            xmax.append(scale_max)
+    return adjusted, output_quantities, np.array(x0), np.array(xmin, dtype=float), np.array(xmax, dtype=float)
+
+
+def _objective(x, project, parset, pars_to_adjust, output_quantities) -> float:
+    return float(atomica.calibration._calculate_objective(np.array(x), pars_to_adjust, output_quantities, parset, project))
+
+
+def _evaluate(x) -> float:
+    data = worker_data()
+    return _objective(x, data["project"], data["parset"], data["pars_to_adjust"], data["output_quantities"])
+
+
+def parallel_calibrate(project: at.Project, parset=None, adjustables: list = None, measurables: list = None, log: str = None, max_time: float = 60, workers: int = None, new_name: str = None, save_to_project: bool = False, time_period=(-np.inf, np.inf), stepsize: float = 0.1, sinc: float = 1.5, sdec: float = 2.0, xtol: float = 1e-4, maxiters: int = 1000, default_min_scale: float = 0.0, default_max_scale: float = 2.0, default_weight: float = 1.0, default_metric: str = "fractional") -> tuple:
+    """
+    Calibrate y-factors by evaluating candidates in parallel
+
+    Starting from the parset's current y-factors, each iteration evaluates a step up and a step down for each
+    adjustable (within its bounds) and moves to the best candidate if it improves the fit, increasing the step
+    size of that adjustable. If no candidate improves the fit, all step sizes are reduced. The search stops
+    when every step size is below ``xtol`` (relative to its initial value), after ``maxiters`` iterations,
+    or when ``max_time`` has elapsed.
+
+    :param project: A :class:`Project`, providing the framework, data and simulation settings
+    :param parset: Name of the parset to calibrate (or a :class:`ParameterSet` instance). By default, the last parset
+    :param adjustables: Parameters to adjust, as for ``Project.calibrate()``. By default, those marked for calibration in the framework
+    :param measurables: Quantities to fit to the data, as for ``Project.calibrate()``. By default, all compartments and characteristics
+    :param log: File for the :class:`CalibrationLog`. If it exists, the calibration is resumed from it. If ``None``, nothing is logged
+    :param max_time: Maximum time in seconds to spend in this call
+    :param workers: Number of worker processes. If ``None``, use one per CPU. With 1 worker, candidates are evaluated serially in this process
+    :param new_name: Name of the calibrated parset. By default, the original name with " (auto-calibrated)" appended
+    :param save_to_project: If True, append the calibrated parset to ``project.parsets``
+    :param time_period: Years of data to fit, for measurables that do not specify their own
+    :param stepsize: Initial step size, relative to each initial y-factor (or absolute, for initial values of 0)
+    :param sinc: Factor to increase the step size by after a successful step
+    :param sdec: Factor to decrease the step sizes by after an iteration without improvement
+    :param xtol: Relative step size below which the search has converged
+    :param maxiters: Maximum number of iterations, including those replayed from the log
+    :param default_min_scale: Lower bound for adjustables given by name only
+    :param default_max_scale: Upper bound for adjustables given by name only
+    :param default_weight: Weight for measurables given by name only
+    :param default_metric: Metric for measurables given by name only
+    :return: Tuple with the calibrated :class:`ParameterSet` and an ``sc.objdict`` of diagnostics
+
+    """
+
+    original = project.parset(parset) if parset is not None else project.parsets[-1]
+    parset = original.copy()
+    pars_to_adjust, output_quantities, x0, xmin, xmax = _expand(project, parset, adjustables, measurables, default_min_scale, default_max_scale, default_weight, default_metric, time_period)
+
+    # Simulate only as far as the data, as done in at.calibrate()
+    sim_project = strip_results(project)
+    sim_project.settings = sc.dcp(project.settings)
+    sim_project.settings.sim_end = min(project.data.tvec[-1], project.settings.sim_end)
+
+    calibration_log = CalibrationLog(log) if log is not None else None
+    if calibration_log is not None:
+        calibration_log.start({"pars": pars_to_adjust, "outputs": [list(x[:4]) + [str(x[4]), str(x[5])] for x in output_quantities], "x0": x0.tolist(), "xmin": xmin.tolist(), "xmax": xmax.tolist()})
+
+    evaluated = {}  # Objective values computed in this call, when there is no log
+    stats = sc.objdict(replayed=0, evaluated=0)
+    workers = n_workers(workers, 2 * len(x0))
+    pool = make_pool(workers, project=sim_project, parset=parset, pars_to_adjust=pars_to_adjust, output_quantities=output_quantities) if workers > 1 else None
+
+    def lookup(x):
+        return calibration_log.get(x) if calibration_log is not None else evaluated.get(quantize(x, 12).tobytes())
+
+    def evaluate(points: list) -> list:
+        # Evaluate points that have not been logged, recording each one as soon as it is returned
+        pending = list({quantize(x, 12).tobytes(): x for x in points if lookup(x) is None}.values())
+        stats.replayed += len(points) - len(pending)
+        values = pool.map(_evaluate, pending, chunksize=max(1, len(pending) // (2 * workers))) if pool is not None else (_objective(x, sim_project, parset, pars_to_adjust, output_quantities) for x in pending)
+        for x, value in zip(pending, values):
+            if calibration_log is not None:
+                calibration_log.append(x, value)
+            else:
+                evaluated[quantize(x, 12).tobytes()] = value
+            stats.evaluated += 1
+        return [lookup(x) for x in points]
+
+    tm = time.perf_counter()
+    x = x0.copy()
+    steps = stepsize * np.where(x0 != 0, np.abs(x0), 1.0)
+    min_steps = xtol * steps
+    converged = False
+    iteration = 0
+    try:
+        f = evaluate([x])[0]
+        initial_objective = f
+        while iteration < maxiters:
+            if np.all(steps < min_steps):
+                converged = True
+                break
+            if time.perf_counter() - tm > max_time:
+                logger.info("Calibration stopped after reaching max_time (%gs) - call again with the same log to continue", max_time)
+                break
+            iteration += 1
+
+            candidates = []
+            for i in range(len(x)):
+                for sign in [1, -1]:
+                    candidate = x.copy()
+                    candidate[i] = np.clip(x[i] + sign * steps[i], xmin[i], xmax[i])
+                    if candidate[i] != x[i]:
+                        candidates.append((i, candidate))
+            if not candidates:
+                converged = True
+                break
+
+            values = evaluate([c for _, c in candidates])
+            best = int(np.argmin(values))
+            if values[best] < f:
+                i, x = candidates[best]
+                f = values[best]
+                steps[i] *= sinc
+            else:
+                steps /= sdec
+            logger.debug("Calibration iteration %d: objective %g", iteration, f)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if calibration_log is not None:
+            calibration_log.close()
+
+    atomica.calibration._update_parset(parset, x, pars_to_adjust)
+    parset.name = new_name if new_name is not None else original.name + " (auto-calibrated)"
+    if save_to_project:
+        project.parsets.append(parset)
+
+    elapsed = time.perf_counter() - tm
+    logger.info("Calibration objective %g -> %g after %d iterations (%d evaluated, %d from the log) in %.1fs", initial_objective, f, iteration, stats.evaluated, stats.replayed, elapsed)
+    diagnostics = sc.objdict(x=x, objective=f, initial_objective=initial_objective, pars=pars_to_adjust, iterations=iteration, evaluated=stats.evaluated, replayed=stats.replayed, converged=converged, time=elapsed)
+    return parset, diagnostics
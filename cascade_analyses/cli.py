@@ -0,0 +1,296 @@
+"""
+Command line entry point for the analyses
+
+Runs stages of any analysis from its configuration file (see :mod:`cascade_analyses.config`). Run from the
+repository root::
+
+    python -m cascade_analyses.cli t2dm-poltava/t2dm_poltava.json                       # Stages in the file's "targets"
+    python -m cascade_analyses.cli hiv-southafrica/hiv_southafrica.json runsim optimize --workers 4
+    python -m cascade_analyses.cli hiv-southafrica/hiv_southafrica.json runsim_programs budget_scenarios --stage-workers 2 --workers 2
+    python -m cascade_analyses.cli hypertension-malawi/hypertension_malawi.json budget_scenarios --no-plots --profile
+    python -m cascade_analyses.cli t2dm-poltava/t2dm_poltava.json optimize --workers 1 --instrument profile.json --cprofile-stage optimize
+
+Each analysis folder also has a script that runs this with its own configuration file, e.g.
+``python hiv_southafrica.py optimize --workers 4``.
+
+Stages run in the folder containing the configuration file, so project caches and outputs are written
+there. Matplotlib's backend is only selected (and ``pylab`` only imported) when a stage actually plots,
+so batch runs with ``--no-plots`` never touch the interactive backend. With ``--plot-folder`` (or ``plot_folder``
+in the configuration), plots are instead rendered to files by a background process (see :class:`PlotQueue`),
+so stages do not wait for them and nothing is shown.
+
+``--workers`` sets the number of worker processes used inside a stage, and ``--stage-workers`` the number of
+stages that can run at the same time, so up to their product of simulations can run at once. Both default to 1.
+
+``--instrument`` records where the time and memory go in each stage (see :class:`Instrumentation`).
+
+"""
+
+import argparse
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import sys
+
+import atomica as at
+import sciris as sc
+
+from .calibration import parallel_calibrate
+from .coverage import allocation_outcomes
+from .config import load_config, make_cache, make_alloc, make_optimization
+from .export import ResultWriter
+from .indicators import print_report, write_summary
+from .instrument import Instrumentation
+from .memoize import EvaluationCache
+from .optimization import multistart_optimize
+from .plotting import PlotQueue, render_plot
+from .uncertainty import run_psa
+from .scenarios import budget_variants, run_scenarios
+from .stages import Pipeline, add_build_stages
+from .system import logger
+
+__all__ = ["build_pipeline", "main"]
+
+
+def _pylab(ctx):
+    # Return pylab, selecting the backend and importing it the first time a stage plots inline
+    if ctx.pl is None:
+        import matplotlib
+
+        matplotlib.use(ctx.config.backend)
+        import pylab
+
+        ctx.pl = pylab
+    return ctx.pl
+
+
+def _plot(ctx, kind: str, *args, **kwargs) -> None:
+    # Queue a plot for the background renderer, or draw it now if plotting inline
+    if ctx.queue is not None:
+        ctx.queue.add(kind, *args, **kwargs)
+    elif ctx.plots:
+        _pylab(ctx)
+        render_plot(kind, *args, **kwargs)
+
+
+def _report(ctx, stage: str, results, spec: dict) -> None:
+    # Print the indicators, and keep the table for the combined summary table
+    ctx.reports[stage] = print_report(results, spec)
+
+
+def _section(ctx, stage: str) -> dict:
+    return ctx.config[stage] or {}
+
+
+def runsim(ctx):
+    sec = _section(ctx, "runsim")
+    ctx.result = ctx.P.run_sim(parset="default", result_name="default", store_results=True)
+    if sec.get("report"):
+        _report(ctx, "runsim", ctx.result, sec["report"])
+
+
+def plotcascade(ctx):
+    sec = _section(ctx, "plotcascade")
+    if not ctx.plots:
+        logger.info("Plotting is disabled - skipping the cascade plot")
+        return "skipped"
+    _plot(ctx, "cascade", ctx.result, cascade=sec.get("cascade"), pops="all", year=sec["years"], data=ctx.P.data, name="calibration_cascade")
+    for plot in sec.get("pop_plots", []):  # Single-population cascades, e.g. {"pops": "adults", "years": [2016]}
+        _plot(ctx, "pop_cascade", ctx.result, cascade=sec.get("cascade"), pops=plot["pops"], year=plot["years"], data=ctx.P.data, name=f"calibration_cascade_{plot['pops']}")
+    if ctx.queue is None:
+        ctx.pl.show()
+
+
+def calibrate(ctx):
+    P = ctx.P
+    sec = _section(ctx, "calibrate")
+    kwargs = {x: sec[x] for x in ["adjustables", "measurables", "max_time", "time_period", "maxiters", "default_min_scale", "default_max_scale", "default_weight", "default_metric"] if x in sec}
+    calibrated, diagnostics = parallel_calibrate(P, parset="default", log=sec.get("log"), workers=ctx.workers, new_name=sec.get("new_name", "auto"), save_to_project=True, **kwargs)
+    if not diagnostics.converged:
+        print(f'Calibration has not converged - run this stage again to continue from "{sec.get("log")}"' if sec.get("log") else "Calibration has not converged")
+
+    if sec.get("plot_years"):
+        results = [P.run_sim(parset="default", result_name="default"), P.run_sim(parset=calibrated, result_name=calibrated.name)]
+        _plot(ctx, "cascade", results, cascade=sec.get("cascade"), year=sec["plot_years"], name="calibrated_cascade")
+
+
+def reconcile(ctx):
+    P = ctx.P
+    sec = _section(ctx, "reconcile")
+    kwargs = {x: sec[x] for x in ["max_time", "unit_cost_bounds", "baseline_bounds", "capacity_bounds", "outcome_bounds"] if x in sec}
+    with EvaluationCache() as evaluations:  # Skip re-evaluating points that ASD has already tried
+        reconciled_progset, progset_comparison, parameter_comparison = at.reconcile(project=P, parset=P.parsets[0], progset=P.progsets[0], reconciliation_year=float(sec["year"]), **kwargs)
+    print("Reconciliation objective cache: %s" % evaluations.stats())
+
+    if sec.get("plot_years") and ctx.plots:
+        instructions = at.ProgramInstructions(start_year=sec.get("start_year", sec["year"]))
+        parresults = P.run_sim(parset="default", result_name="default-noprogs", store_results=True)
+        progresults = P.run_sim(parset="default", progset="default", progset_instructions=instructions, result_name="default-progs", store_results=True)
+        recresults = P.run_sim(parset="default", progset=reconciled_progset, progset_instructions=instructions, result_name="reconciled-progs", store_results=True)
+        _plot(ctx, "cascade", [parresults, progresults, recresults], cascade=sec.get("cascade"), year=sec["plot_years"], name="reconciled_cascade")
+
+    reconciled_progset.save(ctx.config.reconciled_progbook)
+    print(progset_comparison)
+    print(parameter_comparison)
+
+
+def runsim_programs(ctx):
+    P = ctx.P
+    sec = _section(ctx, "runsim_programs")
+    instructions = at.ProgramInstructions(start_year=sec["start_year"])
+    progresults = P.run_sim(parset="default", progset="default", progset_instructions=instructions, result_name="default-progs", store_results=True)
+    results = [progresults]
+    if sec.get("compare_years"):
+        results.insert(0, P.run_sim(parset="default", result_name="default-noprogs", store_results=True))
+    if sec.get("report"):
+        _report(ctx, "runsim_programs", results, sec["report"])
+
+    if sec.get("compare_years"):
+        _plot(ctx, "cascade", results, cascade=sec.get("cascade"), year=sec["compare_years"], name="programs_comparison")
+    _plot(ctx, "cascade", progresults, cascade=sec.get("cascade"), year=sec["plot_years"], name="programs_cascade")
+
+
+def budget_scenarios(ctx):
+    P = ctx.P
+    sec = _section(ctx, "budget_scenarios")
+    default_budget = at.ProgramInstructions(start_year=sec["start_year"], alloc=P.progsets[0])
+
+    # Scenarios are run as one batch, in parallel if there is more than one worker
+    batch = sc.odict([("default-noprogs", None), ("default", default_budget)])
+    batch.update(budget_variants(default_budget, sec.get("factors", [])))
+    results = run_scenarios(P, batch, parset=P.parsets[0], progset=P.progsets[0], workers=ctx.workers, store_results=True, writer=ctx.writer, warm_start=ctx.config.warm_start)
+    ctx.scenarios["budget_scenarios"] = batch
+    if sec.get("report"):
+        _report(ctx, "budget_scenarios", results, sec["report"])
+    if sec.get("outcome_year"):
+        print(allocation_outcomes(P.progsets[0], batch, results[batch.keys().index("default")], sec["outcome_year"]))
+
+    _plot(ctx, "cascade", results, cascade=sec.get("cascade"), year=sec["plot_years"], name="budget_scenarios")
+
+
+def optimize(ctx):
+    P = ctx.P
+    sec = _section(ctx, "optimize")
+    instructions = at.ProgramInstructions(alloc=make_alloc(sec["alloc"]) if sec.get("alloc") else None, start_year=sec["start_year"])
+    optimization = make_optimization(sec, P.progsets[0])
+
+    unoptimized_result = P.run_sim(parset=P.parsets["default"], progset=P.progsets["default"], progset_instructions=instructions, result_name="unoptimized", store_results=True)
+    optimized_instructions, starts = multistart_optimize(P, optimization, parset=P.parsets["default"], progset=P.progsets["default"], instructions=instructions, n_starts=sec.get("n_starts", 1), workers=ctx.workers, cache_size=sec.get("cache_size"), warm_start=ctx.config.warm_start)
+    optimized_result = P.run_sim(parset=P.parsets["default"], progset=P.progsets["default"], progset_instructions=optimized_instructions, result_name="optimized", store_results=True)
+    results = [unoptimized_result, optimized_result]
+    ctx.scenarios["optimize"] = sc.odict([("unoptimized", instructions), ("optimized", optimized_instructions)])
+
+    if sec.get("report"):
+        _report(ctx, "optimize", results, sec["report"])
+
+    _plot(ctx, "cascade", results, cascade=sec.get("cascade"), year=sec["plot_years"], name="optimized_cascade")
+    if sec.get("plot_series"):
+        _plot(ctx, "program_series", optimized_result, name="optimized_spending")
+        _plot(ctx, "program_series", unoptimized_result, name="unoptimized_spending")
+    _plot(ctx, "programs", [optimized_result, unoptimized_result], t_bins=sec.get("program_bins"), year=sec.get("program_year"), name="optimized_programs")
+
+    if ctx.writer is not None:
+        ctx.writer.write_all(results)
+    if sec.get("export_xlsx"):
+        at.export_results([optimized_result, unoptimized_result], sec["export_xlsx"])
+
+
+def uncertainty(ctx):
+    P = ctx.P
+    sec = _section(ctx, "uncertainty")
+    kwargs = {x: sec[x] for x in ["report", "cascade", "cascade_years", "pops", "default_cv", "sample_progset", "quantiles", "seed", "max_attempts"] if x in sec}
+    psa = run_psa(P, ctx.scenarios[sec.get("scenarios", "optimize")], n_samples=sec["n_samples"], parset=P.parsets[0], progset=P.progsets[0], workers=ctx.workers, **kwargs)
+    print(psa.summary())
+    ctx.psa = psa
+
+
+def build_pipeline(config: sc.objdict, plots: bool = True, workers: int = None, queue: PlotQueue = None) -> Pipeline:
+    """
+    Make the pipeline for an analysis
+
+    The project-building stages are always added. Other stages are added if the configuration has a section for them.
+    File names are interpreted relative to the current directory, so this should be called from ``config.folder``.
+
+    :param config: A configuration returned by :func:`load_config`
+    :param plots: If False, stages do not plot (and Matplotlib's backend is never selected)
+    :param queue: Optionally provide a :class:`PlotQueue` to render plots to files instead of plotting inline
+    :param workers: Number of worker processes for scenarios and optimization. By default, ``config.workers``
+    :return: A :class:`Pipeline`
+
+    """
+
+    cache = make_cache(config)
+    writer = ResultWriter(config.results) if config.results else None
+    pipeline = Pipeline(context={"config": config, "plots": plots, "pl": None, "queue": queue if plots else None, "reports": {}, "scenarios": {}, "workers": workers or config.workers, "writer": writer})
+    add_build_stages(pipeline, cache, settings=config.settings, databook_args=config.databook_args, blank_databook=config.blank_databook, blank_progbook=config.blank_progbook, progs=config.progs, retention=config.retention)
+
+    pipeline.add("runsim", runsim)
+    if config.calibrate is not None:
+        pipeline.add("calibrate", calibrate, main_thread=True)
+    if config.plotcascade is not None:
+        pipeline.add("plotcascade", plotcascade, main_thread=True)
+    if config.reconcile is not None and config.reconciled_progbook:
+        pipeline.add("reconcile", reconcile, main_thread=True, inputs=[config.framework, config.databook, config.progbook], outputs=config.reconciled_progbook)
+    for name, func in [("runsim_programs", runsim_programs), ("budget_scenarios", budget_scenarios), ("optimize", optimize)]:
+        if config[name] is not None:
+            pipeline.add(name, func, main_thread=True)
+    if config.uncertainty is not None:
+        pipeline.add("uncertainty", uncertainty, main_thread=True, requires=[config.uncertainty.get("scenarios", "optimize")])
+    return pipeline
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Run stages of a cascade analysis")
+    parser.add_argument("config", help="Analysis configuration file (JSON)")
+    parser.add_argument("stages", nargs="*", help='Stages to run (default: the "targets" in the configuration file). Stages they depend on are added automatically')
+    parser.add_argument("--workers", type=int, help="Number of worker processes used by each scenario, optimization, calibration or uncertainty stage")
+    parser.add_argument("--stage-workers", type=int, help="Number of stages that can run at the same time (in threads)")
+    parser.add_argument("--profile", action="store_true", help="Profile the run with cProfile and print the functions with the highest cumulative time. Only stages run in the main thread are profiled, so use --stage-workers 1 to profile everything")
+    parser.add_argument("--instrument", metavar="REPORT", help="Record calls, wall time and peak memory of each stage and Atomica call, and write them to this JSON file (with a text summary alongside)")
+    parser.add_argument("--cprofile-stage", action="append", metavar="STAGE", help="With --instrument, also capture a cProfile of this stage (can be given more than once)")
+    parser.add_argument("--no-plots", action="store_true", help="Do not plot")
+    parser.add_argument("--plot-folder", help="Save plots to this folder, rendering them in a background process instead of showing them")
+    parser.add_argument("--force", nargs="*", help="Run these stages even if their outputs are up to date (all stages if none are listed)")
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    plot_folder = os.path.abspath(args.plot_folder) if args.plot_folder else config.plot_folder  # On the command line, relative to the current directory
+    instrument_path = os.path.abspath(args.instrument) if args.instrument else None
+    os.chdir(config.folder)
+    workers = args.workers or config.workers
+    stage_workers = args.stage_workers or config.stage_workers
+    queue = PlotQueue(plot_folder, fmt=config.plot_format) if plot_folder and not args.no_plots else None
+    pipeline = build_pipeline(config, plots=not args.no_plots, workers=workers, queue=queue)
+    force = (args.force or True) if args.force is not None else None
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    instrumentation = Instrumentation(cprofile=args.cprofile_stage) if args.instrument else None
+    pipeline.instrumentation = instrumentation
+    try:
+        with instrumentation if instrumentation is not None else contextlib.nullcontext():
+            pipeline.run(args.stages or config.targets, workers=stage_workers, force=force)
+    finally:
+        if config.report_table and pipeline.context.reports:
+            write_summary(pipeline.context.reports, config.report_table)
+            print(f'Wrote the reports of {len(pipeline.context.reports)} stage(s) to "{config.report_table}"')
+        if instrumentation is not None:
+            print(instrumentation.summary())
+            files = instrumentation.save(instrument_path)
+            print(f'Wrote "{files[0]}" and "{files[1]}"')
+        if queue is not None:
+            files = queue.close()
+            print(f'Wrote {len(files)} plot files to "{queue.folder}"')
+        if profiler is not None:
+            profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(30)
+            print(stream.getvalue())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
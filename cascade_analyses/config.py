@@ -0,0 +1,146 @@
+"""
+Per-analysis configuration files
+
+Each analysis folder contains a JSON file that specifies its inputs, simulation settings and the
+settings for each stage, so that a single command line entry point (:mod:`cascade_analyses.cli`)
+can run any of them. For example::
+
+    {
+        "name": "Poltava T2DM project",
+        "framework": "t2dm_poltava_framework.xlsx",
+        "databook": "t2dm_poltava_databook.xlsx",
+        "progbook": "t2dm_poltava_progbook.xlsx",
+        "settings": {"sim_start": 2014.0, "sim_end": 2025.0, "sim_dt": 1.0},
+        "targets": ["runsim_programs"],
+        "runsim_programs": {"start_year": 2016, "plot_years": [2016, 2017, 2018, 2019, 2020]},
+        "optimize": {...}
+    }
+
+File names are relative to the folder containing the configuration file. Entries that are not
+specified take their values from :data:`DEFAULTS`. A stage can only be run if the configuration
+has a section for it (except for the project-building stages, which only need the file names).
+
+"""
+
+import json
+import os
+
+import atomica as at
+import sciris as sc
+
+from .build import ProjectCache
+
+__all__ = ["DEFAULTS", "STAGE_SECTIONS", "load_config", "make_cache", "make_alloc", "make_optimization"]
+
+#: Default values for entries that are not specified in a configuration file
+DEFAULTS = {
+    "name": None,
+    "framework": None,
+    "databook": None,
+    "progbook": None,
+    "reconciled_progbook": None,  # Written by the 'reconcile' stage
+    "load_reconciled": False,  # If True, load the reconciled progbook instead of the progbook
+    "settings": None,  # Arguments for Project.update_settings(), e.g. {"sim_start": 2017.0, "sim_end": 2030, "sim_dt": 0.25}
+    "databook_args": None,  # Arguments for Project.create_databook() in the 'makedatabook' stage
+    "blank_databook": None,
+    "blank_progbook": None,
+    "progs": None,  # Program specification for Project.make_progbook() in the 'makeblankprogbook' stage
+    "targets": ["runsim"],  # Stages to run if none are specified on the command line
+    "warm_start": True,  # Resume scenario and optimization runs from a checkpoint before the program start year (see Checkpoint)
+    "stage_workers": 1,  # Number of stages that can run at the same time (in threads)
+    "workers": 1,  # Number of worker processes used by each scenario, optimization, calibration or uncertainty stage
+    "backend": "TkAgg",  # Matplotlib backend, only selected if a stage plots
+    "plot_folder": None,  # If set, plots are saved to this folder by a background process instead of being shown
+    "plot_format": "png",  # File format for plots saved to plot_folder
+    "report_table": None,  # If set, the indicator tables of all stages with a report are written to this file (.csv or .xlsx)
+    "retention": None,  # Arguments for retain_results(), e.g. {"variables": ["num_acq"], "dtype": "float32", "max_full": 4}
+    "results": None,  # Folder that results are streamed to (see ResultWriter)
+}
+
+#: Stages that take their settings from a section of the configuration file. Sections that are not specified are ``None``
+STAGE_SECTIONS = ["runsim", "calibrate", "plotcascade", "reconcile", "runsim_programs", "budget_scenarios", "optimize", "uncertainty"]
+
+
+def load_config(path: str) -> sc.objdict:
+    """
+    Read an analysis configuration file
+
+    :param path: Path to a JSON configuration file
+    :return: An ``sc.objdict`` with the defaults filled in, ``None`` for any stage sections that are not specified,
+             and ``folder`` set to the folder containing the file
+
+    """
+
+    with open(path) as f:
+        config = json.load(f)
+    unknown = [x for x in config if x not in DEFAULTS and x not in STAGE_SECTIONS]
+    if unknown:
+        raise Exception(f'Unknown entries {unknown} in configuration file "{path}"')
+    for key in ["framework", "databook"]:
+        if not config.get(key):
+            raise Exception(f'Configuration file "{path}" must specify a "{key}"')
+    out = sc.objdict(sc.mergedicts(sc.dcp(DEFAULTS), dict.fromkeys(STAGE_SECTIONS), config))
+    out.folder = os.path.dirname(os.path.abspath(path))
+    return out
+
+
+def make_cache(config: sc.objdict) -> ProjectCache:
+    """
+    Make the project cache for an analysis
+
+    File names are interpreted relative to the current directory, so this should be called from ``config.folder``.
+
+    :param config: A configuration returned by :func:`load_config`
+    :return: A :class:`ProjectCache`
+
+    """
+
+    progbook = config.reconciled_progbook if config.load_reconciled else config.progbook
+    return ProjectCache(framework=config.framework, databook=config.databook, progbook=progbook, name=config.name or "default")
+
+
+def make_alloc(spec: dict) -> sc.odict:
+    """
+    Make a spending allocation from a configuration entry
+
+    :param spec: Dict keyed by program name, with values that are either a number (constant spending) or a dict
+                 with ``t`` and ``vals`` lists, e.g. ``{"PMTCT": {"t": [2017, 2022], "vals": [15727557, 20714379]}}``
+    :return: An ``sc.odict`` of :class:`TimeSeries`, suitable for ``ProgramInstructions(alloc=...)``
+
+    """
+
+    alloc = sc.odict()
+    for prog_name, value in spec.items():
+        alloc[prog_name] = at.TimeSeries(value["t"], value["vals"]) if isinstance(value, dict) else at.TimeSeries(assumption=value)
+    return alloc
+
+
+def make_optimization(spec: dict, progset: at.ProgramSet) -> at.Optimization:
+    """
+    Make an optimization from a configuration entry
+
+    :param spec: The 'optimize' section of a configuration. It contains
+
+                 - ``adjustments``: dict with ``years``, ``limit_type`` ('abs' or 'rel'), ``lower`` and ``upper`` and optionally
+                   ``programs`` (by default, every program in the progset is adjusted)
+                 - ``measurable``: dict with ``type`` (the name of an Atomica measurable class, e.g. 'MaximizeCascadeStage'),
+                   ``cascade`` and ``years``, and any other arguments for that class (e.g. ``pop_names``)
+                 - ``constraint``: dict of arguments for :class:`TotalSpendConstraint` (``{}`` keeps the total spending the same),
+                   or ``null`` for no constraint
+                 - ``method``: optionally specify the optimization method (default 'asd')
+
+    :param progset: The :class:`ProgramSet` being optimized
+    :return: An :class:`Optimization`
+
+    """
+
+    adj = spec["adjustments"]
+    programs = adj.get("programs") or list(progset.programs.keys())
+    adjustments = [at.SpendingAdjustment(x, adj["years"], adj.get("limit_type", "rel"), adj.get("lower", 0.0), adj.get("upper", None)) for x in programs]
+
+    measurable = dict(spec["measurable"])
+    measurable_class = getattr(at, measurable.pop("type"))
+    measurables = measurable_class(measurable.pop("cascade"), measurable.pop("years"), **measurable)
+
+    constraints = at.TotalSpendConstraint(**spec["constraint"]) if spec.get("constraint") is not None else None
+    return at.Optimization(name="default", adjustments=adjustments, measurables=measurables, constraints=constraints, method=spec.get("method", "asd"))
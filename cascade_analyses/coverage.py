@@ -0,0 +1,222 @@
+"""
+Vectorized evaluation of program coverage-outcome functions
+
+``Covout.get_outcome()`` evaluates one (par, pop) outcome for a single coverage dict at a single time.
+Exploring thousands of candidate allocations that way means a Python call per candidate, per time,
+per covout. :class:`CovoutBatch` precomputes the program ordering, outcome deltas and impact-interaction
+tables of every covout in a progset, groups covouts with the same coverage interaction and number of
+programs, and evaluates each group for all candidates and times in NumPy. The results match
+``Covout.get_outcome()`` for the 'additive', 'random' and 'nested' coverage interactions.
+
+Typical usage::
+
+    batch = CovoutBatch(P.progsets[0])
+    coverage = np.random.rand(1000, len(batch.programs), len(tvec))  # Proportion coverage, in the order of batch.programs
+    outcomes = batch.evaluate(coverage)  # Shape (1000, len(batch.keys), len(tvec))
+
+or, for a set of program instructions, :func:`allocation_outcomes`. The coverage interactions are evaluated
+from the outcome tables that each ``Covout`` caches in ``update_outcomes()``. These are private to Atomica, so
+:class:`CovoutBatch` checks that they are present and raises an error if a different version of Atomica does
+not provide them.
+
+"""
+
+import numpy as np
+import atomica as at
+import sciris as sc
+
+__all__ = ["CovoutBatch", "spending_to_coverage", "allocation_outcomes"]
+
+_COVOUT_CACHE = ["_cached_progs", "_deltas", "_combination_outcomes"]  # Set by Covout.update_outcomes()
+
+
+class CovoutBatch:
+    """
+    Evaluate all covouts in a progset at once
+
+    :param progset: A :class:`ProgramSet`
+    :param chunk_size: Maximum number of (candidate, time) points evaluated in one NumPy operation. Interaction
+                       calculations allocate arrays of size ``chunk_size * 2**n_progs * n_progs`` per group, so
+                       this bounds peak memory
+
+    """
+
+    def __init__(self, progset: at.ProgramSet, chunk_size: int = 10000):
+        self.programs = list(progset.programs.keys())  #: Program names, in the order of the program axis of the coverage array
+        self.keys = list(progset.covouts.keys())  #: (par, pop) tuples, in the order of the covout axis of the outcome array
+        self.chunk_size = chunk_size
+
+        prog_index = {x: i for i, x in enumerate(self.programs)}
+        groups = sc.odict()
+        for k, covout in enumerate(progset.covouts.values()):
+            missing = [x for x in _COVOUT_CACHE if not hasattr(covout, x)]
+            if missing:
+                raise Exception(f"CovoutBatch needs the cached outcomes of each Covout ({', '.join(missing)}), which Atomica {at.__version__} does not provide - evaluate outcomes with Covout.get_outcome() instead")
+            n = covout.n_progs
+            interaction = covout.cov_interaction if n > 1 else "single"  # All interactions are the same with 0 or 1 programs
+            group = groups.setdefault((interaction, n), sc.objdict(interaction=interaction, n=n, rows=[], progs=[], baseline=[], deltas=[], outcomes=[]))
+            group.rows.append(k)
+            group.progs.append([prog_index[x] for x in covout._cached_progs.keys()])  # Programs sorted by outcome magnitude, as in Covout
+            group.baseline.append(covout.baseline)
+            group.deltas.append(covout._deltas if n else np.zeros(0))
+            group.outcomes.append(covout._combination_outcomes.ravel() if n > 1 else np.zeros(0))
+
+        for group in groups.values():
+            group.rows = np.array(group.rows, dtype=int)
+            group.progs = np.array(group.progs, dtype=int).reshape(len(group.rows), group.n)
+            group.baseline = np.array(group.baseline, dtype=float)
+            group.deltas = np.array(group.deltas, dtype=float).reshape(len(group.rows), group.n)
+            group.outcomes = np.array(group.outcomes, dtype=float).reshape(len(group.rows), -1)
+            if group.n > 1:
+                # Combinations are ordered as in Covout, with the first program as the most significant bit
+                group.combinations = np.array([[(m >> (group.n - 1 - j)) & 1 for j in range(group.n)] for m in range(2**group.n)], dtype=float)
+                group.weights = 2 ** (group.n - 1 - np.arange(group.n))  # Combination index contributed by each program
+        self.groups = list(groups.values())
+
+    def __repr__(self):
+        return f"<CovoutBatch {len(self.keys)} covouts, {len(self.programs)} programs, {len(self.groups)} groups>"
+
+    def evaluate(self, coverage) -> np.ndarray:
+        """
+        Return outcomes for many coverage scenarios
+
+        :param coverage: Array of proportion coverage with shape ``(n_candidates, n_programs, n_times)``, with programs in the
+                         order of :attr:`programs`. A 2-D array ``(n_programs, n_times)`` is treated as a single candidate
+        :return: Array of outcomes with shape ``(n_candidates, n_covouts, n_times)``, with covouts in the order of :attr:`keys`
+                 (or ``(n_covouts, n_times)`` for 2-D input)
+
+        """
+
+        coverage = np.asarray(coverage, dtype=float)
+        squeeze = coverage.ndim == 2
+        if squeeze:
+            coverage = coverage[None]
+        n_candidates, n_programs, n_times = coverage.shape
+        if n_programs != len(self.programs):
+            raise Exception(f"Coverage has {n_programs} programs but the progset has {len(self.programs)}")
+
+        # Flatten candidates and times into a single sample axis, with programs last
+        samples = coverage.transpose(0, 2, 1).reshape(-1, n_programs)
+        out = np.empty((samples.shape[0], len(self.keys)))
+        for start in range(0, samples.shape[0], self.chunk_size):
+            chunk = samples[start : start + self.chunk_size]
+            for group in self.groups:
+                out[start : start + self.chunk_size, group.rows] = self._evaluate_group(group, chunk)
+
+        out = out.reshape(n_candidates, n_times, -1).transpose(0, 2, 1)
+        return out[0] if squeeze else out
+
+    def _evaluate_group(self, group, samples: np.ndarray) -> np.ndarray:
+        # Return outcomes with shape (n_samples, n_covouts_in_group)
+        n = group.n
+        if n == 0:
+            return np.broadcast_to(group.baseline, (samples.shape[0], len(group.rows)))
+
+        cov = samples[:, group.progs]  # (samples, covouts, n)
+        outcome = np.broadcast_to(group.baseline, cov.shape[:2]).copy()
+
+        if group.interaction == "single":
+            return outcome + cov[..., 0] * group.deltas[:, 0]
+
+        combos = group.combinations  # (m, n)
+        if group.interaction == "additive":
+            simple = outcome + np.sum(cov * group.deltas, axis=-1)
+            over = np.sum(cov, axis=-1) > 1  # The interaction calculation is only required where total coverage exceeds 1
+            if not over.any():
+                return simple
+            c = cov[over]  # (k, n)
+            additive = np.maximum(c - np.maximum(c - (1 - (np.cumsum(c, axis=-1) - c)), 0), 0)
+            remainder = 1 - additive
+            random = c - additive
+            random_portion = np.divide(random, remainder, out=np.zeros_like(random), where=remainder != 0)
+            additive_portion = combos * additive[:, None, :]  # (k, m, n)
+            net_random = combos * random_portion[:, None, :] + (1 - combos) * (1 - random_portion[:, None, :])
+            # Product of net_random over all programs except each one in turn, via prefix and suffix products
+            ones = np.ones(net_random.shape[:-1] + (1,))
+            prefix = np.cumprod(np.concatenate([ones, net_random[..., :-1]], axis=-1), axis=-1)
+            suffix = np.cumprod(np.concatenate([ones, net_random[..., :0:-1]], axis=-1), axis=-1)[..., ::-1]
+            combination_coverage = np.sum(additive_portion * prefix * suffix, axis=-1)  # (k, m)
+            outcomes = group.outcomes[np.nonzero(over)[1]]  # (k, m) - outcome table for the covout of each flagged entry
+            simple[over] = outcome[over] + np.sum(combination_coverage * outcomes, axis=-1)
+            return simple
+
+        elif group.interaction == "random":
+            combination_coverage = np.prod(combos * cov[..., None, :] + (1 - combos) * (1 - cov[..., None, :]), axis=-1)  # (samples, covouts, m)
+            return outcome + np.sum(combination_coverage * group.outcomes, axis=-1)
+
+        elif group.interaction == "nested":
+            # Programs are removed from the combination in increasing order of coverage. Each step contributes the
+            # coverage increment times the outcome of the combination of programs that remain
+            idx = np.argsort(cov, axis=-1)
+            sorted_cov = np.take_along_axis(cov, idx, axis=-1)
+            increments = np.diff(sorted_cov, axis=-1, prepend=0)
+            removed = np.cumsum(group.weights[idx], axis=-1) - group.weights[idx]  # Index weight of programs removed before each step
+            combination_index = group.weights.sum() - removed
+            outcomes = np.take_along_axis(np.broadcast_to(group.outcomes, cov.shape[:2] + group.outcomes.shape[-1:]), combination_index, axis=-1)
+            return outcome + np.sum(increments * outcomes, axis=-1)
+
+        else:
+            raise Exception(f'Unknown coverage interaction "{group.interaction}"')
+
+
+def spending_to_coverage(progset: at.ProgramSet, spending, tvec, dt: float, num_eligible: dict, programs: list = None) -> np.ndarray:
+    """
+    Convert spending for many candidate allocations into proportion coverage
+
+    This uses each program's own ``get_capacity()`` and ``get_prop_covered()`` methods, with the candidates
+    flattened onto the time axis, so unit costs, capacity constraints and saturation are applied exactly as
+    in ``ProgramSet.get_capacities()`` and ``ProgramSet.get_prop_coverage()`` (without instruction overwrites).
+
+    :param progset: A :class:`ProgramSet`
+    :param spending: Array of annual spending with shape ``(n_candidates, n_programs, n_times)``
+    :param tvec: Array of ``n_times`` times
+    :param dt: Simulation time step
+    :param num_eligible: Dict keyed by program name, with the number of people eligible at each time in ``tvec``
+                         (for example, from ``Result.get_coverage('eligible', year=tvec)`` for a baseline result)
+    :param programs: Program names in the order of the program axis. By default, the order of ``progset.programs``
+    :return: Array of proportion coverage with the same shape as ``spending``, ready for :meth:`CovoutBatch.evaluate`
+
+    """
+
+    spending = np.asarray(spending, dtype=float)
+    tvec = sc.promotetoarray(tvec)
+    programs = programs if programs is not None else list(progset.programs.keys())
+    n_candidates = spending.shape[0]
+    tiled_t = np.tile(tvec, n_candidates)
+
+    coverage = np.empty_like(spending)
+    for j, prog_name in enumerate(programs):
+        prog = progset.programs[prog_name]
+        capacity = prog.get_capacity(tiled_t, spending[:, j, :].ravel(), dt)
+        eligible = np.tile(sc.promotetoarray(num_eligible[prog_name]), n_candidates)
+        coverage[:, j, :] = np.minimum(prog.get_prop_covered(tiled_t, capacity, eligible), 1.0).reshape(n_candidates, len(tvec))
+    return coverage
+
+
+def allocation_outcomes(progset: at.ProgramSet, allocations: dict, baseline: at.Result, year: float):
+    """
+    Return the program outcomes of several allocations in one year
+
+    Spending is converted to coverage with the number of people eligible in the baseline result, and the
+    outcomes of every allocation are evaluated at once by a :class:`CovoutBatch`. These are the outcomes the
+    allocations would have in that year with the baseline's population, i.e. before the model responds to them,
+    so they are a quick comparison of allocations rather than a substitute for running them.
+
+    :param progset: A :class:`ProgramSet`
+    :param allocations: Dict of :class:`ProgramInstructions` keyed by name. Entries that are ``None`` (no programs) are skipped
+    :param baseline: A :class:`Result` to take the number of people eligible for each program from
+    :param year: The year to evaluate
+    :return: A DataFrame with a row for each (parameter, population) outcome and a column for each allocation
+
+    """
+
+    import pandas as pd
+
+    allocations = {k: v for k, v in allocations.items() if v is not None}
+    batch = CovoutBatch(progset)
+    tvec = np.array([float(year)])
+    spending = np.array([[progset.get_alloc(tvec, instructions)[x] for x in batch.programs] for instructions in allocations.values()])  # (allocation, program, 1)
+    coverage = spending_to_coverage(progset, spending, tvec, baseline.dt, baseline.get_coverage("eligible", year=tvec), programs=batch.programs)
+    outcomes = batch.evaluate(coverage)[:, :, 0]
+    index = pd.MultiIndex.from_tuples(batch.keys, names=["Parameter", "Population"])
+    return pd.DataFrame(outcomes.T, index=index, columns=list(allocations.keys()))
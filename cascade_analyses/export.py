@@ -0,0 +1,283 @@
+"""
+Streaming result export
+
+``at.export_results()`` writes every result to a single xlsx workbook at the end of a run, which is slow
+and memory-hungry for sweeps with many results. :class:`ResultWriter` instead writes each result to its
+own compressed NPZ chunk as soon as it is available, and appends a line describing it to a JSON-lines
+manifest. An archive is a folder containing the chunks and ``manifest.jsonl``::
+
+    results/
+        manifest.jsonl
+        00000.npz
+        00001.npz
+
+Chunks are written to a temporary file and renamed before their manifest line is appended, so an
+interrupted run leaves a readable archive containing every result that had finished. Opening a writer
+on an existing archive appends to it. Writing a result with a name that is already in the archive
+supersedes the earlier entry, and its chunk is deleted. :meth:`ResultArchive.compact` rewrites the manifest
+without superseded entries and deletes any chunks it does not refer to (e.g. left by an interrupted run).
+
+Typical usage::
+
+    writer = ResultWriter("results")
+    run_scenarios(P, variants, writer=writer)  # Each result is written as soon as it is returned
+    archive = ResultArchive("results")
+    archive.stack("num_acq").sum(axis=1)  # Array (result, time)
+    export_xlsx(archive, "results.xlsx", names=archive.names[:3])  # Optional workbook for a subset
+
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+import atomica as at
+import sciris as sc
+
+from .results import ResultStore, stack_stores
+from .system import logger
+
+__all__ = ["ResultWriter", "ResultArchive", "export_xlsx"]
+
+MANIFEST = "manifest.jsonl"
+
+
+def _read_manifest(path: str) -> sc.odict:
+    # Return the entries in an archive manifest keyed by result name. Later lines supersede earlier ones, and an
+    # incomplete final line (from an interrupted write) is ignored
+    entries = sc.odict()
+    fname = os.path.join(path, MANIFEST)
+    if not os.path.exists(fname):
+        return entries
+    with open(fname) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning('Ignoring incomplete line in "%s"', fname)
+                continue
+            entries.pop(entry["name"], None)
+            entries[entry["name"]] = entry
+    return entries
+
+
+def _remove(fname: str) -> None:
+    try:
+        os.remove(fname)
+    except FileNotFoundError:
+        pass
+
+
+class ResultWriter:
+    """
+    Write results to an archive one at a time
+
+    :param path: Folder containing the archive. It is created when the first result is written if it does not exist, and appended to if it does
+    :param variables: Optionally specify a list of variable code names to write. By default, all variables are written
+    :param pops: Optionally specify a list of population code names to write. By default, all populations are written
+    :param dtype: Data type of the stored values (e.g. ``np.float32`` to halve the file size)
+
+    """
+
+    def __init__(self, path: str, variables: list = None, pops: list = None, dtype=float):
+        self.path = path
+        self.variables = variables
+        self.pops = pops
+        self.dtype = dtype
+        self._next = None  # Number of the next chunk, set from the existing chunks on the first write
+        self._files = None  # Maps result name to chunk file, read from the manifest on the first write
+        self._lock = threading.Lock()  # Stages running in different threads can share a writer
+
+    def __repr__(self):
+        return f'<ResultWriter "{self.path}">'
+
+    def write(self, result, name: str = None, metadata: dict = None) -> dict:
+        """
+        Write one result
+
+        :param result: A :class:`Result` or :class:`ResultStore`
+        :param name: Optionally specify the name to store the result under. By default, the result's name is used
+        :param metadata: Optionally specify a dict of JSON-serializable values to record in the manifest
+        :return: The manifest entry for the result
+
+        """
+
+        if isinstance(result, ResultStore):
+            store = result.subset(self.variables, self.pops) if (self.variables is not None or self.pops is not None) else result
+        else:
+            store = ResultStore.from_result(result, variables=self.variables, pops=self.pops, dtype=self.dtype)
+
+        with self._lock:
+            if self._next is None:
+                os.makedirs(self.path, exist_ok=True)
+                existing = [x for x in os.listdir(self.path) if x.endswith(".npz") and x[:-4].isdigit()]
+                self._next = max([int(x[:-4]) for x in existing], default=-1) + 1  # Chunk numbers are never reused
+                self._files = {name: entry["file"] for name, entry in _read_manifest(self.path).items()}
+            fname = f"{self._next:05d}.npz"
+            self._next += 1
+
+        tmp = os.path.join(self.path, fname + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez_compressed(f, t=store.t, data=store.data.astype(self.dtype, copy=False), variables=np.array(store.variables), pops=np.array(store.pops))
+        os.replace(tmp, os.path.join(self.path, fname))
+
+        entry = {"name": name if name is not None else store.name, "file": fname, "shape": list(store.data.shape), "t": [float(store.t[0]), float(store.t[-1])] if len(store.t) else [], "dtype": np.dtype(self.dtype).name, "created": str(sc.now()), "metadata": metadata or {}}
+        with self._lock:
+            with open(os.path.join(self.path, MANIFEST), "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            superseded = self._files.get(entry["name"])
+            self._files[entry["name"]] = fname
+        if superseded is not None and superseded != fname:
+            _remove(os.path.join(self.path, superseded))
+            logger.debug('Removed chunk "%s" superseded by "%s"', superseded, fname)
+        return entry
+
+    def write_all(self, results: list, names: list = None) -> list:
+        """
+        Write several results
+
+        :param results: List of :class:`Result` or :class:`ResultStore` instances
+        :param names: Optionally specify a name for each result
+        :return: List of manifest entries
+
+        """
+
+        results = sc.promotetolist(results)
+        names = names if names is not None else [None] * len(results)
+        return [self.write(result, name) for result, name in zip(results, names)]
+
+
+class ResultArchive:
+    """
+    Read results from an archive
+
+    Results are loaded lazily, one chunk at a time.
+
+    :param path: Folder containing the archive
+
+    """
+
+    def __init__(self, path: str):
+        if not os.path.exists(os.path.join(path, MANIFEST)):
+            raise Exception(f'"{path}" does not contain a result archive')
+        self.path = path
+        self.entries = _read_manifest(path)  #: Manifest entries keyed by result name
+
+    def __repr__(self):
+        return f'<ResultArchive "{self.path}" {len(self.entries)} results>'
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __iter__(self):
+        for name in self.entries.keys():
+            yield self.load(name)
+
+    @property
+    def names(self) -> list:
+        return list(self.entries.keys())
+
+    def load(self, name: str) -> ResultStore:
+        """
+        Load one result
+
+        :param name: Name of the result
+        :return: A :class:`ResultStore`
+
+        """
+
+        if name not in self.entries:
+            raise at.NotFoundError(f'Result "{name}" is not in the archive "{self.path}"')
+        if not os.path.exists(os.path.join(self.path, self.entries[name]["file"])):
+            self.entries = _read_manifest(self.path)  # The result has been written again since the manifest was read, and its old chunk removed
+        with np.load(os.path.join(self.path, self.entries[name]["file"]), allow_pickle=False) as chunk:
+            return ResultStore(name, chunk["t"], chunk["variables"].tolist(), chunk["pops"].tolist(), chunk["data"])
+
+    def stack(self, variables=None, pops=None, names: list = None) -> np.ndarray:
+        """
+        Stack the same selection from several results
+
+        Chunks can list their variables and populations in different orders (e.g. for results made in worker
+        processes), so values are selected by name in every chunk.
+
+        :param variables: A variable name, a list of names, or ``None`` for all variables in the first result
+        :param pops: A population name, a list of names, or ``None`` for all populations in the first result
+        :param names: Optionally specify a list of result names. By default, all results in the archive are used
+        :return: Array with a leading result axis, as for :func:`stack_stores`
+
+        """
+
+        names = names if names is not None else self.names
+        stores = [self.load(x) for x in names]
+        if stores:
+            variables = variables if variables is not None else stores[0].variables
+            pops = pops if pops is not None else stores[0].pops
+        return stack_stores(stores, variables, pops)
+
+    def compact(self) -> list:
+        """
+        Remove superseded entries and unused chunks
+
+        The manifest is rewritten with only the current entry for each result, and chunk files (and partially
+        written temporary files) that it does not refer to are deleted. Do not compact an archive while a
+        :class:`ResultWriter` is writing to it.
+
+        :return: List of the files that were deleted
+
+        """
+
+        self.entries = _read_manifest(self.path)
+        fname = os.path.join(self.path, MANIFEST)
+        with open(fname + ".tmp", "w") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(fname + ".tmp", fname)
+
+        used = {entry["file"] for entry in self.entries.values()}
+        removed = sorted(x for x in os.listdir(self.path) if (x.endswith(".npz") or x.endswith(".npz.tmp")) and x not in used)
+        for x in removed:
+            _remove(os.path.join(self.path, x))
+        logger.info('Compacted result archive "%s" - removed %d unused file(s)', self.path, len(removed))
+        return removed
+
+
+def export_xlsx(archive: ResultArchive, filename: str, names: list = None, variables: list = None, pops: list = None) -> None:
+    """
+    Write results from an archive to an xlsx workbook
+
+    Each result is written to its own sheet, with a row for each variable and population and a column for each time.
+    Rows where a variable is not present in a population are omitted.
+
+    :param archive: A :class:`ResultArchive`, or the path to one
+    :param filename: The xlsx file to write
+    :param names: Optionally specify a list of result names to write. By default, all results in the archive are written
+    :param variables: Optionally specify a list of variable code names to write
+    :param pops: Optionally specify a list of population code names to write
+
+    """
+
+    import pandas as pd
+
+    if not isinstance(archive, ResultArchive):
+        archive = ResultArchive(archive)
+    names = names if names is not None else archive.names
+
+    with pd.ExcelWriter(filename) as writer:
+        for i, name in enumerate(names):
+            store = archive.load(name)
+            var_names = sc.promotetolist(variables) if variables is not None else store.variables
+            pop_names = sc.promotetolist(pops) if pops is not None else store.pops
+            data = store.get(var_names, pop_names).reshape(-1, len(store.t))
+            index = pd.MultiIndex.from_product([var_names, pop_names], names=["Variable", "Population"])
+            df = pd.DataFrame(data, index=index, columns=store.t).dropna(how="all")
+            sheet = f"{i}_{name}"[:31]  # Excel limits sheet names to 31 characters
+            df.to_excel(writer, sheet_name="".join(x if x not in "[]:*?/\\" else "_" for x in sheet))
+    logger.info('Exported %d results to "%s"', len(names), filename)
@@ -0,0 +1,206 @@
+"""
+Indicators defined by report specifications
+
+The printed summaries in the analyses (new infections and deaths by year, the proportion of people with
+diabetes who have vascular disease, the number of people in each cascade stage) are all sums of a few
+variables, aggregated over years and compared between results. A report specification declares them::
+
+    {
+        "years": [2017, 2018, 2019, 2020, 2021],
+        "indicators": {
+            "Infections": {"variables": ["num_acq"], "aggregate": "sum", "annualise": true},
+            "Deaths": {"variables": ["num_hiv_deaths"], "aggregate": "sum", "annualise": true},
+            "Diagnosed": {"variables": ["all_dx"], "pops": ["adults"]},
+            "Proportion diagnosed": {"numerator": "Diagnosed", "denominator": ["Diagnosed", "Undiagnosed"]}
+        }
+    }
+
+Each indicator is either
+
+- a dict with ``variables`` (summed over variables and populations), optionally ``pops``, ``aggregate``
+  ('sum', 'mean' or 'at' - the value at the start of each year, the default) and ``annualise``
+  (for 'sum', multiply by the timestep to convert annual rates into totals), or
+- a dict with ``numerator`` and ``denominator``, which are labels (or lists of labels, which are summed) of
+  other indicators listed before it.
+
+:func:`summary_table` tabulates the indicators for any number of results, with totals over the years and the
+reduction in each result relative to a baseline, and :func:`write_summary` writes the tables of several
+comparisons (e.g. the scenarios and optimization of an analysis) to a single file.
+
+"""
+
+import numpy as np
+import sciris as sc
+
+from .results import ResultStore, stack_stores
+from .retention import RetainedResult
+from .years import YearIndex
+
+__all__ = ["indicator_variables", "evaluate_indicators", "summary_table", "write_summary", "print_report"]
+
+
+def indicator_variables(spec: dict) -> list:
+    """
+    Return the variables that a report specification needs
+
+    :param spec: A report specification
+    :return: List of variable names, without duplicates
+
+    """
+
+    return list(dict.fromkeys(x for ind in spec["indicators"].values() for x in ind.get("variables", [])))
+
+
+def _stores(results: list, variables: list) -> list:
+    # Stores for results given as Result, ResultStore or RetainedResult instances
+    stores = []
+    for x in sc.promotetolist(results):
+        if isinstance(x, ResultStore):
+            stores.append(x)
+        elif isinstance(x, RetainedResult):
+            stores.append(x.store)
+        else:
+            stores.append(ResultStore.from_result(x, variables=variables))
+    return stores
+
+
+def _total(values: sc.odict, labels) -> np.ndarray:
+    # Sum of the values of one or more indicators that have already been computed
+    return np.sum([values[x] for x in sc.promotetolist(labels)], axis=0)
+
+
+def evaluate_indicators(results: list, spec: dict) -> tuple:
+    """
+    Compute the indicators in a report specification
+
+    The values of all the variables are stacked into one array, from which every indicator in the specification is
+    computed for every result at once.
+
+    :param results: A :class:`Result` or list of results (or :class:`ResultStore` or :class:`RetainedResult` instances containing the variables)
+    :param spec: A report specification
+    :return: Tuple with the :class:`YearIndex` for the report years, and an ``sc.odict`` keyed by indicator label
+             containing an array (result, year) for each indicator
+
+    """
+
+    variables = indicator_variables(spec)
+    stores = _stores(results, variables)
+    years = YearIndex(stores[0].t, spec["years"])
+    pops = stores[0].pops
+    data = stack_stores(stores, variables, pops)  # Array (result, variable, population, time)
+    absent = np.isnan(data).all(axis=-1)  # Variables that are not in a population count as 0
+    data = np.where(absent[..., None], 0, data)
+
+    # Weights (indicator, variable, population) select what each indicator sums, so that all of them are one product
+    indicators = spec["indicators"]
+    summed = [label for label, ind in indicators.items() if "numerator" not in ind]
+    weights = np.zeros((len(summed), len(variables), len(pops)))
+    for k, label in enumerate(summed):
+        ind = indicators[label]
+        pop_idx = [pops.index(x) for x in ind["pops"]] if ind.get("pops") else slice(None)
+        for name in ind["variables"]:
+            weights[k, variables.index(name), pop_idx] = 1
+    series = np.einsum("rvpt,kvp->krt", np.nan_to_num(data), weights)  # Array (indicator, result, time)
+    series[np.einsum("rvpt,kvp->krt", np.isnan(data), weights) > 0] = np.nan  # Other NaNs only affect the indicators that include them
+
+    # Aggregate each group of indicators with the same aggregation over years in one go
+    aggregated = np.empty(series.shape[:2] + (len(years.bins),))
+    groups = sc.odict()
+    for k, label in enumerate(summed):
+        ind = indicators[label]
+        aggregate = ind.get("aggregate", "at")
+        if aggregate not in {"sum", "mean", "at"}:
+            raise Exception(f'Unknown aggregate "{aggregate}" for indicator "{label}" - must be "sum", "mean" or "at"')
+        groups.setdefault((aggregate, bool(ind.get("annualise", False))), []).append(k)
+    for (aggregate, annualise), idx in groups.items():
+        if aggregate == "sum":
+            aggregated[idx] = years.sum(series[idx], annualise=annualise)
+        elif aggregate == "mean":
+            aggregated[idx] = years.mean(series[idx])
+        else:
+            aggregated[idx] = years.at(series[idx], [x[0] for x in years.bins])
+
+    values = sc.odict()
+    for label, ind in indicators.items():
+        if "numerator" in ind:
+            values[label] = _total(values, ind["numerator"]) / _total(values, ind["denominator"])
+        else:
+            values[label] = aggregated[summed.index(label)]
+    return years, values
+
+
+def summary_table(results: list, spec: dict, names: list = None, baseline: int = 0):
+    """
+    Tabulate indicators for one or more results
+
+    For each indicator, there is a row for each result, followed by a row for the relative reduction in each other
+    result compared to the baseline. Indicators that are summed over years also have a total over all years.
+
+    :param results: A :class:`Result` or list of results (or :class:`ResultStore` or :class:`RetainedResult` instances)
+    :param spec: A report specification
+    :param names: Optionally specify a name for each result. By default, the names of the results
+    :param baseline: Index of the result that reductions are computed relative to
+    :return: A ``pandas.DataFrame`` indexed by (indicator, row), with a column for each report year and, if any
+             indicator is summed, a 'Total' column
+
+    """
+
+    import pandas as pd
+
+    results = sc.promotetolist(results)
+    years, values = evaluate_indicators(results, spec)
+    names = names if names is not None else [x.name for x in results]
+    any_summed = any(x.get("aggregate") == "sum" for x in spec["indicators"].values())
+    others = [i for i in range(len(results)) if i != baseline]
+
+    index, rows = [], []
+    for label, vals in values.items():
+        summed = spec["indicators"][label].get("aggregate") == "sum"
+        totals = vals.sum(axis=1, keepdims=True) if summed else np.full((len(vals), 1), np.nan)
+        table = np.hstack([vals, totals]) if any_summed else vals  # Array (result, column)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            reductions = (table[baseline] - table[others]) / table[baseline]
+        index += [(label, x) for x in names] + [(label, f"reduction ({names[i]})") for i in others]
+        rows += [table, reductions]
+    columns = years.labels + (["Total"] if any_summed else [])
+    return pd.DataFrame(np.vstack(rows), index=pd.MultiIndex.from_tuples(index, names=["Indicator", "Row"]), columns=columns)
+
+
+def write_summary(tables, filename: str) -> None:
+    """
+    Write one or more summary tables to a single file
+
+    :param tables: A table from :func:`summary_table`, or a dict of tables (e.g. keyed by stage), which are
+                   combined into one table with the key as an extra first level of the index
+    :param filename: File to write. The format is set by the extension - '.csv' or '.xlsx'
+
+    """
+
+    import pandas as pd
+
+    table = pd.concat(tables, names=["Report"]) if isinstance(tables, dict) else tables
+    if filename.endswith(".xlsx"):
+        table.to_excel(filename)
+    elif filename.endswith(".csv"):
+        table.to_csv(filename)
+    else:
+        raise Exception(f'Unknown format for summary table "{filename}" - the extension must be ".csv" or ".xlsx"')
+
+
+def print_report(results: list, spec: dict):
+    """
+    Print indicators for one or more results
+
+    :param results: A :class:`Result` or list of results. With more than one result, the reduction relative to the first is also printed
+    :param spec: A report specification
+    :return: The table that was printed, from :func:`summary_table`
+
+    """
+
+    table = summary_table(results, spec)
+    print("%-30s" % "" + "".join("%14s" % x for x in table.columns))
+    for label in table.index.get_level_values(0).unique():
+        print(label)
+        for name, row in table.loc[label].iterrows():
+            print("  %-28s" % name[:28] + "".join("%14.6g" % x if np.isfinite(x) else "%14s" % "" for x in row))
+    return table
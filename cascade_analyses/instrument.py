@@ -0,0 +1,330 @@
+"""
+Instrumentation of pipeline stages and Atomica calls
+
+The stage timings of a :class:`Pipeline` show that 'optimize' is slow, but not whether the time goes in
+parsing spreadsheets, evaluating programs, integrating the model or packaging results. While an
+:class:`Instrumentation` is active, it wraps the Atomica functions in :data:`HOOKS` and records the number of
+calls, wall time and peak memory of each of them, attributed to the pipeline stage that made the call. It can
+also capture a cProfile of selected stages. The report is a JSON-compatible dict (plus a text summary), so
+reports from two runs can be compared with :func:`compare_reports`.
+
+Typical usage::
+
+    with Instrumentation(cprofile=["optimize"]) as instrumentation:
+        pipeline.instrumentation = instrumentation
+        pipeline.run(["optimize"])
+    instrumentation.save("profile.json")  # Also writes profile.txt
+    print(instrumentation.summary())
+
+or from the command line, ``python -m cascade_analyses.cli <config> optimize --instrument profile.json``.
+
+Times are inclusive, so a ``run_sim`` call includes the ``model`` and ``result`` calls inside it. Peak
+memory (measured with ``tracemalloc``, which slows Python code down) is the largest increase in traced
+memory during a call. Only calls in this process are recorded, so use one worker to include simulations that
+would otherwise run in worker processes. Stages running concurrently in threads share the memory trace, so
+their peak memory figures overlap. The wrappers are installed with the same patch registry as
+:class:`EvaluationCache` and :class:`WarmStart`, so they can be combined in any order, but only one
+:class:`Instrumentation` can be active at a time.
+
+"""
+
+import contextlib
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import threading
+import time
+import tracemalloc
+
+import atomica as at
+import sciris as sc
+
+from .system import patched
+from .warmstart import Checkpoint
+
+__all__ = ["HOOKS", "Instrumentation", "compare_reports"]
+
+#: Functions that are instrumented, as ``(object, attribute name)``. Each is replaced by a wrapper while an :class:`Instrumentation` is active
+HOOKS = sc.odict(
+    [
+        ("framework", (at.ProjectFramework, "__init__")),  # Parsing a framework spreadsheet
+        ("run_sim", (at.Project, "run_sim")),
+        ("optimize", (at, "optimize")),
+        ("reconcile", (at, "reconcile")),
+        ("model", (at.Model, "__init__")),  # Building a model from the parset and progset
+        ("integrate", (at.Model, "process")),  # Model integration
+        ("resume", (Checkpoint, "resume")),  # Warm-started model integration
+        ("program_cache", (at.Model, "_update_program_cache")),  # Program capacities and coverage for the whole simulation
+        ("program_outcomes", (at.ProgramSet, "get_outcomes")),  # Program outcomes, at every timestep
+        ("result", (at.Result, "__init__")),  # Packaging a processed model as a result
+    ]
+)
+
+_NO_STAGE = "(outside stages)"
+_active = None  # The Instrumentation that is currently active
+_active_lock = threading.Lock()
+
+
+class _Frame:
+    # An instrumented call in progress
+    def __init__(self, key: tuple, base: int):
+        self.key = key
+        self.base = base  # Traced memory when the call started
+        self.peak = base  # Highest traced memory seen by calls inside this one, which reset the tracemalloc peak
+
+
+class Instrumentation:
+    """
+    Record calls, wall time and peak memory of pipeline stages and Atomica calls
+
+    :param hooks: Names of the entries of :data:`HOOKS` to instrument. By default, all of them
+    :param memory: If True, trace memory allocations to record peak memory
+    :param cprofile: Names of stages to capture with cProfile. Each must run in a single thread, i.e. be flagged ``main_thread`` or run with one stage worker
+    :param cprofile_lines: Number of functions listed in the cProfile summary of each stage
+
+    """
+
+    def __init__(self, hooks: list = None, memory: bool = True, cprofile: list = None, cprofile_lines: int = 30):
+        self.hooks = list(HOOKS.keys()) if hooks is None else sc.promotetolist(hooks)
+        for name in self.hooks:
+            if name not in HOOKS:
+                raise Exception(f'Unknown hook "{name}" - must be one of {list(HOOKS.keys())}')
+        self.memory = memory
+        self.cprofile = set(sc.promotetolist(cprofile))
+        self.cprofile_lines = cprofile_lines
+        self.stats = sc.odict()  #: Statistics keyed by ``(stage, name)``, where the name is "stage" for the stage itself
+        self.profiles = sc.odict()  #: cProfile statistics of each profiled stage, as ``pstats.Stats``
+        self._local = threading.local()  # The stage and stack of calls in progress in each thread
+        self._lock = threading.Lock()
+        self._patches = None
+        self._started_tracing = False
+        self.started = None
+        self.elapsed = None
+
+    def __repr__(self):
+        return f"<Instrumentation of {len(self.hooks)} hooks with {len(self.stats)} entries>"
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+            self._local.stage = _NO_STAGE
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def record(self, name: str, stage: str = None):
+        """
+        Record a call
+
+        :param name: Label for the call
+        :param stage: If provided, calls made by this thread inside the block are attributed to this stage
+
+        """
+
+        stack = self._stack()
+        previous_stage = self._local.stage
+        if stage is not None:
+            self._local.stage = stage
+        key = (self._local.stage, name)
+
+        tracing = self.memory and tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+        frame = _Frame(key, current if tracing else 0)
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            peak = None
+            if tracing:
+                frame.peak = max(frame.peak, tracemalloc.get_traced_memory()[1])
+                peak = frame.peak - frame.base
+                if stack:
+                    stack[-1].peak = max(stack[-1].peak, frame.peak)
+            self._local.stage = previous_stage
+            with self._lock:
+                if key not in self.stats:
+                    self.stats[key] = sc.objdict(calls=0, time=0.0, min=None, max=None, peak_memory=None)
+                entry = self.stats[key]
+                entry.calls += 1
+                entry.time += elapsed
+                entry.min = elapsed if entry.min is None else min(entry.min, elapsed)
+                entry.max = elapsed if entry.max is None else max(entry.max, elapsed)
+                if peak is not None:
+                    entry.peak_memory = peak if entry.peak_memory is None else max(entry.peak_memory, peak)
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Record a pipeline stage, and the calls made inside it
+
+        :param name: Name of the stage. If it is one of the stages in ``cprofile``, it is also profiled
+
+        """
+
+        profiler = cProfile.Profile() if name in self.cprofile else None
+        with self.record("stage", stage=name):
+            if profiler is not None:
+                profiler.enable()
+            try:
+                yield
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                    with self._lock:
+                        self.profiles[name] = pstats.Stats(profiler)
+
+    def _handler(self, name: str):
+        def handler(call, *args, **kwargs):
+            if os.getpid() != self._pid:
+                return call(*args, **kwargs)  # In a forked worker process, whose records would be lost anyway
+            with self.record(name):
+                return call(*args, **kwargs)
+
+        return handler
+
+    def __enter__(self):
+        global _active
+        with _active_lock:
+            if _active is self:
+                raise Exception("This Instrumentation is already active")
+            elif _active is not None:
+                raise Exception("Another Instrumentation is already active")
+            _active = self
+        self._pid = os.getpid()
+        self._patches = contextlib.ExitStack()
+        for name in self.hooks:
+            obj, attr = HOOKS[name]
+            self._patches.enter_context(patched(obj, attr, self._handler(name), shared=True))  # Calls from every thread are recorded
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.started = str(sc.now())
+        self._start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        global _active
+        self.elapsed = time.perf_counter() - self._start_time
+        self._patches.close()
+        self._patches = None
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        with _active_lock:
+            _active = None
+
+    def report(self) -> dict:
+        """
+        Return the recorded statistics
+
+        :return: A JSON-compatible dict with the ``environment``, the total ``time``, and for each stage its ``calls``
+                 (keyed by hook name, with the stage's own entry under "stage") and, if it was profiled, the cProfile summary
+
+        """
+
+        stages = {}
+        for (stage, name), entry in self.stats.items():
+            stages.setdefault(stage, {"calls": {}})["calls"][name] = dict(entry)
+        for stage, stats in self.profiles.items():
+            stream = io.StringIO()
+            stats.stream = stream
+            stats.sort_stats("cumulative").print_stats(self.cprofile_lines)
+            stages[stage]["cprofile"] = stream.getvalue()
+
+        return {
+            "environment": {"atomica": at.__version__, "sciris": sc.__version__, "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(), "date": self.started},
+            "memory": self.memory,
+            "time": self.elapsed,
+            "stages": stages,
+        }
+
+    def summary(self, report: dict = None) -> str:
+        """
+        Return a text table of the recorded statistics
+
+        :param report: Optionally provide a report from :meth:`report` (or a loaded JSON file). By default, the current statistics
+        :return: A string with one line per stage and call
+
+        """
+
+        return _summarize(report if report is not None else self.report())
+
+    def save(self, path: str) -> tuple:
+        """
+        Write the report as JSON, and the text summary to a file with the same name and extension '.txt'
+
+        :param path: Name of the JSON file
+        :return: Tuple with the names of the JSON and text files
+
+        """
+
+        report = self.report()
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        text_path = os.path.splitext(path)[0] + ".txt"
+        with open(text_path, "w") as f:
+            f.write(self.summary(report) + "\n")
+            for stage, entry in report["stages"].items():
+                if "cprofile" in entry:
+                    f.write(f'\ncProfile of stage "{stage}"\n{entry["cprofile"]}')
+        return path, text_path
+
+
+def _fmt(x, spec: str) -> str:
+    # Format a value that may be missing
+    return format(x, spec) if x is not None else "-"
+
+
+def _summarize(report: dict) -> str:
+    env = report["environment"]
+    lines = [f"Atomica {env['atomica']}, Python {env['python']} on {env['platform']} ({env['cpus']} CPUs) - {env['date']}", ""]
+    lines.append(f"{'Stage / call':<30}{'Calls':>8}{'Time (s)':>12}{'Mean (ms)':>12}{'% of stage':>12}{'Peak (MB)':>12}")
+    for stage, entry in report["stages"].items():
+        calls = entry["calls"]
+        total = calls["stage"]["time"] if "stage" in calls else None
+        for name, x in sorted(calls.items(), key=lambda item: (item[0] != "stage", -item[1]["time"])):
+            label = stage if name == "stage" else "  " + name
+            share = 100 * x["time"] / total if total else None
+            peak = x["peak_memory"] / 1e6 if x["peak_memory"] is not None else None
+            lines.append(f"{label[:29]:<30}{x['calls']:>8}{x['time']:>12.4f}{1000 * x['time'] / x['calls']:>12.3f}{_fmt(share, '.1f'):>12}{_fmt(peak, '.1f'):>12}")
+    if report["time"] is not None:
+        lines.append(f"{'Total':<30}{'':>8}{report['time']:>12.4f}")
+    return "\n".join(lines)
+
+
+def compare_reports(baseline: dict, current: dict, threshold: float = 0.2) -> list:
+    """
+    Compare the time and memory of two reports
+
+    :param baseline: A report from :meth:`Instrumentation.report` (or the loaded JSON file) for the reference run
+    :param current: A report for the new run
+    :param threshold: Relative change in total time, or in peak memory, above which an entry is included
+    :return: List of dicts with the ``stage``, ``name`` and the ``baseline`` and ``current`` calls, time and peak memory,
+             for each stage and call that is in both reports and has changed by more than the threshold, or that is
+             only in one of them
+
+    """
+
+    changes = []
+    stages = list(baseline["stages"].keys()) + [x for x in current["stages"].keys() if x not in baseline["stages"]]
+    for stage in stages:
+        old = baseline["stages"].get(stage, {"calls": {}})["calls"]
+        new = current["stages"].get(stage, {"calls": {}})["calls"]
+        for name in list(old.keys()) + [x for x in new.keys() if x not in old]:
+            a, b = old.get(name), new.get(name)
+            if a is not None and b is not None:
+                slower = abs(b["time"] - a["time"]) > threshold * a["time"]
+                bigger = a["peak_memory"] is not None and b["peak_memory"] is not None and abs(b["peak_memory"] - a["peak_memory"]) > threshold * a["peak_memory"]
+                if not (slower or bigger or a["calls"] != b["calls"]):
+                    continue
+            changes.append({"stage": stage, "name": name, "baseline": a, "current": b})
+    return changes
@@ -0,0 +1,188 @@
+"""
+Memoized objective evaluations for optimization and reconciliation
+
+``at.optimize()`` and ``at.reconcile()`` both use ASD, which frequently proposes points that have already
+been evaluated, or that differ from an earlier point only by floating-point rounding. Each evaluation in
+``at.optimize()`` is a full model run. :class:`EvaluationCache` stores objective values keyed by a quantized
+copy of the proposed vector together with the identity of the inputs that the objective depends on (the
+pickled model - which contains the parset, progset and instructions - plus the optimization, constraints and
+baselines, or for reconciliation the progset and targets), so repeated points return immediately.
+
+Typical usage::
+
+    cache = EvaluationCache(maxsize=5000)
+    with cache:
+        optimized_instructions = at.optimize(P, optimization, parset=parset, progset=progset, instructions=instructions)
+    print(cache.stats())
+
+While the cache is active, calls to the objective functions in ``atomica.optimization`` and
+``atomica.reconciliation`` made by the thread that entered it are memoized. Other threads are not affected,
+so stages running concurrently in a :class:`Pipeline` each use their own cache (or none). The same cache can
+be active in several threads at once, in which case they share its values.
+
+"""
+
+import contextlib
+import hashlib
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import atomica.optimization
+import atomica.reconciliation
+import sciris as sc
+
+from .system import patched
+
+__all__ = ["quantize", "EvaluationCache"]
+
+
+def quantize(x, digits: int = 8) -> np.ndarray:
+    """
+    Round values to a fixed number of significant figures
+
+    :param x: Array of values
+    :param digits: Number of significant figures to keep
+    :return: Array of rounded values, so that values that differ only by floating-point error compare equal
+
+    """
+
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        magnitude = np.floor(np.log10(np.abs(x)))
+    magnitude[~np.isfinite(magnitude)] = 0  # Zeros (and non-finite values) are left unscaled
+    scale = 10.0 ** (digits - 1 - magnitude)
+    return np.round(x * scale) / scale
+
+
+class EvaluationCache:
+    """
+    Bounded LRU cache of objective values
+
+    :param maxsize: Maximum number of objective values to store. The least recently used value is evicted when the cache is full
+    :param digits: Number of significant figures used to quantize the proposed vectors before looking them up
+
+    """
+
+    def __init__(self, maxsize: int = 10000, digits: int = 8):
+        self.maxsize = maxsize
+        self.digits = digits
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values = OrderedDict()
+        self._digests = OrderedDict()  # Maps id(obj) to (obj, digest) for recently hashed inputs
+        self._objects = dict()  # Maps id(obj) to obj for inputs identified by object - holding the object ensures its id is not reused while active
+        self._generation = 0  # Incremented each time the cache is activated, so object identities from earlier activations never match
+        self._lock = threading.Lock()
+        self._active = 0  # Number of threads in which the cache is active
+        self._local = threading.local()  # The patches installed by each thread
+
+    def __repr__(self):
+        return sc.prepr(self)
+
+    def __len__(self):
+        return len(self._values)
+
+    def stats(self) -> dict:
+        """
+        Return cache statistics
+
+        :return: Dict with the number of hits, misses, evictions, stored values and the hit rate
+
+        """
+
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self._values), "hit_rate": self.hits / total if total else 0.0}
+
+    def clear(self) -> None:
+        """
+        Remove all stored values and reset the statistics
+
+        """
+
+        with self._lock:
+            self._values.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def _digest(self, obj, by_content: bool) -> str:
+        # Return a token for an input argument. With by_content, equal objects give equal tokens (so repeated
+        # at.optimize calls on the same inputs share entries). Otherwise, the token identifies the object
+        # itself, for inputs like the progset in reconciliation that are modified in place.
+        key = id(obj)
+        if not by_content:
+            self._objects[key] = obj
+            return f"id:{self._generation}:{key}"
+        if key not in self._digests or self._digests[key][0] is not obj:
+            if isinstance(obj, bytes):
+                # A pickled Model - clear its creation time, which is the only thing that differs between
+                # models built from the same inputs, so that repeated at.optimize() calls share entries
+                model = pickle.loads(obj)
+                model.created = None
+                obj_payload = pickle.dumps(model)
+            else:
+                obj_payload = pickle.dumps(obj)
+            self._digests[key] = (obj, hashlib.sha1(obj_payload).hexdigest())
+            if len(self._digests) > 32:
+                self._digests.popitem(last=False)
+        return self._digests[key][1]
+
+    def evaluate(self, fcn, x, identity: tuple):
+        """
+        Return an objective value, computing it only if it has not been stored
+
+        :param fcn: Function to call as ``fcn()`` if the value is not in the cache
+        :param x: The proposed vector
+        :param identity: Tuple identifying everything other than ``x`` that the objective depends on
+        :return: The objective value
+
+        """
+
+        key = (identity, quantize(x, self.digits).tobytes())
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                self.hits += 1
+                return self._values[key]
+            self.misses += 1
+
+        value = fcn()
+
+        with self._lock:
+            self._values[key] = value
+            if len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def _optimization_objective(self, objective, x, pickled_model, optimization, hard_constraints, baselines):
+        with self._lock:
+            identity = ("optimize",) + tuple(self._digest(x, True) for x in [pickled_model, optimization, hard_constraints, baselines])
+        return self.evaluate(lambda: objective(x, pickled_model=pickled_model, optimization=optimization, hard_constraints=hard_constraints, baselines=baselines), x, identity)
+
+    def _reconciliation_objective(self, objective, x, mapping, progset, eval_years, target_vals, num_eligible, dt):
+        with self._lock:
+            identity = ("reconcile", self._digest(progset, False), self._digest(target_vals, False), float(dt))
+        return self.evaluate(lambda: objective(x, mapping, progset, eval_years, target_vals, num_eligible, dt), x, identity)
+
+    def __enter__(self):
+        if getattr(self._local, "patches", None) is not None:
+            raise Exception("This EvaluationCache is already active in this thread")
+        with self._lock:
+            if not self._active:
+                self._generation += 1
+            self._active += 1
+        self._local.patches = contextlib.ExitStack()
+        self._local.patches.enter_context(patched(atomica.optimization, "_objective_fcn", self._optimization_objective))
+        self._local.patches.enter_context(patched(atomica.reconciliation, "_objective", self._reconciliation_objective))
+        return self
+
+    def __exit__(self, *args):
+        self._local.patches.close()
+        self._local.patches = None
+        with self._lock:
+            self._active -= 1
+            if not self._active:
+                self._digests.clear()  # Release references to the inputs
+                self._objects.clear()
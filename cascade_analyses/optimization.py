@@ -0,0 +1,186 @@
+"""
+Multi-start optimization
+
+A single call to ``at.optimize()`` performs a local search from the allocation in the program
+instructions, so it can stall in a local optimum. :func:`multistart_optimize` instead runs several
+independent optimizations from different initial allocations (and optionally with different methods)
+on a process pool, and returns the best result.
+
+All starts share the same bounds, hard constraints and measurable baselines, which are computed
+once from the original instructions - exactly as ``at.optimize()`` would compute them - so relative
+spending bounds and total spending constraints are the same for every start. The first start always
+begins from the original allocation, so with ``n_starts=1`` the result is the same as ``at.optimize()``.
+
+"""
+
+import contextlib
+import pickle
+from concurrent.futures import as_completed
+
+import numpy as np
+import atomica as at
+import sciris as sc
+
+from .memoize import EvaluationCache
+from .parallel import make_pool, worker_data, strip_results, n_workers
+from .system import logger
+from .warmstart import WarmStart
+
+__all__ = ["initial_allocations", "multistart_optimize"]
+
+
+def initial_allocations(x0, xmin, xmax, n_starts: int, spread: float = 0.5, seed: int = None) -> list:
+    """
+    Generate starting points for a multi-start optimization
+
+    The first starting point is ``x0`` itself. The others multiply each element of ``x0`` by an
+    independent lognormal factor and are then clipped to the bounds. Because total spending constraints
+    rescale the allocation, this is effectively a random reallocation of the budget between programs.
+
+    :param x0: Initial values of the adjustables
+    :param xmin: Lower bounds of the adjustables
+    :param xmax: Upper bounds of the adjustables
+    :param n_starts: Total number of starting points
+    :param spread: Standard deviation of the log of the multiplicative perturbation
+    :param seed: Optionally specify a random seed
+    :return: List of ``n_starts`` arrays
+
+    """
+
+    x0 = np.array(x0, dtype=float)
+    rng = np.random.default_rng(seed)
+    starts = [x0.copy()]
+    for _ in range(n_starts - 1):
+        starts.append(np.clip(x0 * np.exp(rng.normal(0, spread, size=x0.shape)), xmin, xmax))
+    return starts
+
+
+def _allocation_vector(instructions: at.ProgramInstructions) -> np.ndarray:
+    # Flatten the spending in a set of instructions so that allocations from different starts can be compared
+    return np.concatenate([np.ravel(instructions.alloc[k].vals) for k in sorted(instructions.alloc.keys())] or [np.zeros(0)])
+
+
+_worker_cache = None  # Evaluation cache in a pool worker process, shared by all starts run in that worker
+
+
+def _run_start(task: tuple, project=None, optimization=None, parset=None, progset=None, instructions=None, setup=None, cache=None) -> sc.objdict:
+    # Run one optimization start. In worker processes, the shared arguments come from worker_data()
+    global _worker_cache
+    index, x0, method, optim_args = task
+    if project is None:
+        data = worker_data()
+        project, optimization, parset, progset, instructions, setup = [data[x] for x in ["project", "optimization", "parset", "progset", "instructions", "setup"]]
+        if setup.cache_size and _worker_cache is None:
+            _worker_cache = EvaluationCache(maxsize=setup.cache_size)  # Workers only live as long as their pool
+        cache = _worker_cache
+
+    optimization = sc.dcp(optimization)
+    if method is not None:
+        optimization.method = method
+    diagnostics = sc.objdict(start=index, method=optimization.method, objective=np.nan, x0=x0, instructions=None, allocation=None, time=np.nan, status="ok", error=None)
+
+    tm = sc.tic()
+    try:
+        # The warm start is entered first, so that the cache only calls the warm-started objective on a miss
+        with WarmStart() if setup.warm_start else contextlib.nullcontext(), cache if cache is not None else contextlib.nullcontext():
+            optimized = at.optimize(project, optimization, parset=parset, progset=progset, instructions=instructions, x0=x0, xmin=setup.xmin, xmax=setup.xmax, hard_constraints=setup.hard_constraints, baselines=setup.baselines, optim_args=optim_args)
+        model = at.Model(project.settings, project.framework, parset, progset, optimized)
+        model.process()
+        diagnostics.objective = optimization.compute_objective(model, setup.baselines)
+        diagnostics.instructions = optimized
+        diagnostics.allocation = _allocation_vector(optimized)
+    except (at.InvalidInitialConditions, at.FailedConstraint) as E:
+        diagnostics.status = "failed"
+        diagnostics.error = str(E)
+    diagnostics.time = sc.toc(tm, output=True)
+    diagnostics.cache = cache.stats() if cache is not None else None  # Cumulative over the starts run so far in the same process by this call
+    return diagnostics
+
+
+def multistart_optimize(project: at.Project, optimization: at.Optimization, parset, progset, instructions: at.ProgramInstructions, n_starts: int = 4, methods: list = None, x0s: list = None, spread: float = 0.5, seed: int = None, optim_args: dict = None, workers: int = None, cache_size: int = None, warm_start: bool = False, converge_tol: float = 0.01, converge_count: int = 3, callback=None) -> tuple:
+    """
+    Run several independent optimizations and return the best
+
+    Starts are run in parallel. As each one finishes, the best objective so far is logged (and passed to ``callback``
+    if provided). If ``converge_count`` starts have finished with allocations within ``converge_tol`` of the best allocation,
+    the optimization is considered converged and starts that have not yet begun are cancelled.
+
+    :param project: A :class:`Project` instance
+    :param optimization: An :class:`Optimization` instance
+    :param parset: A :class:`ParameterSet` instance, or the name of one in the project
+    :param progset: A :class:`ProgramSet` instance, or the name of one in the project
+    :param instructions: A :class:`ProgramInstructions` instance containing the reference allocation
+    :param n_starts: Number of starts (ignored if ``x0s`` is provided)
+    :param methods: Optionally specify a list of optimization methods (e.g. ``['asd', 'pso']``), cycled over the starts.
+                    By default, ``optimization.method`` is used for all starts
+    :param x0s: Optionally specify a list of initial values for the adjustables, one per start. By default, they are generated by :func:`initial_allocations`
+    :param spread: Spread of the random starting points, see :func:`initial_allocations`
+    :param seed: Optionally specify a random seed for the starting points
+    :param optim_args: Dictionary of arguments passed to ``at.optimize()`` for every start
+    :param workers: Number of worker processes. If ``None``, use one per CPU. With 1 worker, starts are run serially in this process
+    :param cache_size: If provided, memoize objective evaluations in an :class:`EvaluationCache` of this size. Each process (this one, or each worker) has one cache for this call, shared by the starts it runs
+    :param warm_start: If True, resume each objective evaluation from a :class:`Checkpoint` at the program start year (see :class:`WarmStart`)
+    :param converge_tol: Relative (L1) difference below which two allocations are considered the same
+    :param converge_count: Number of starts that must agree with the best allocation to stop early. Set to ``None`` to always run every start
+    :param callback: Optionally specify a function that is called with the diagnostics of each start as it finishes, and the diagnostics of the best start so far
+    :return: Tuple with the best optimized :class:`ProgramInstructions`, and a list with the diagnostics of each start, in order of start index.
+             Each entry has ``start``, ``method``, ``objective``, ``x0``, ``instructions``, ``allocation``, ``time``, ``status``, ``error`` and ``cache`` (the cache statistics)
+
+    """
+
+    parset = project.parset(parset)
+    progset = project.progset(progset)
+
+    # Compute bounds, constraints and baselines from the reference instructions, as done in at.optimize()
+    model = at.Model(project.settings, project.framework, parset, progset, instructions)
+    x0, xmin, xmax = optimization.get_initialization(progset, model.program_instructions)
+    setup = sc.objdict(xmin=xmin, xmax=xmax, cache_size=cache_size, warm_start=warm_start)
+    setup.hard_constraints = optimization.get_hard_constraints(x0, model.program_instructions)
+    setup.baselines = optimization.get_baselines(pickle.dumps(model))
+
+    if x0s is None:
+        x0s = initial_allocations(x0, xmin, xmax, n_starts, spread=spread, seed=seed)
+    methods = sc.promotetolist(methods) if methods is not None else [None]
+    tasks = [(i, x, methods[i % len(methods)], optim_args) for i, x in enumerate(x0s)]
+    workers = n_workers(workers, len(tasks))
+
+    done = []
+    best = None
+
+    def record(diagnostics) -> bool:
+        # Store a finished start, log progress, and return True if enough starts have converged
+        nonlocal best
+        done.append(diagnostics)
+        if diagnostics.status == "ok" and (best is None or diagnostics.objective < best.objective):
+            best = diagnostics
+        logger.info("Optimization start %d (%s) finished in %.1fs with objective %s - best so far is %s", diagnostics.start, diagnostics.method, diagnostics.time, diagnostics.objective, best.objective if best else None)
+        if callback is not None:
+            callback(diagnostics, best)
+        if best is None or not converge_count:
+            return False
+        scale = max(np.abs(best.allocation).sum(), np.finfo(float).tiny)
+        agree = sum(1 for x in done if x.status == "ok" and np.abs(x.allocation - best.allocation).sum() / scale <= converge_tol)
+        return agree >= converge_count
+
+    if workers == 1:
+        cache = EvaluationCache(maxsize=cache_size) if cache_size else None  # Released when this call returns
+        for task in tasks:
+            if record(_run_start(task, project, optimization, parset, progset, instructions, setup, cache)):
+                break
+    else:
+        with make_pool(workers, project=strip_results(project), optimization=optimization, parset=parset, progset=progset, instructions=instructions, setup=setup) as pool:
+            futures = [pool.submit(_run_start, task) for task in tasks]
+            converged = False
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                if record(future.result()) and not converged:
+                    converged = True
+                    cancelled = sum(x.cancel() for x in futures)  # Starts that are already running are allowed to finish
+                    logger.info("Optimization starts have converged - cancelled %d remaining start(s)", cancelled)
+
+    if best is None:
+        raise at.InvalidInitialConditions(f"None of the {len(done)} optimization starts succeeded")
+    done.sort(key=lambda x: x.start)
+    logger.info("Best objective %s from start %d of %d", best.objective, best.start, len(done))
+    return best.instructions, done
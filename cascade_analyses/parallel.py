@@ -0,0 +1,90 @@
+"""
+Process pools that receive shared data once per worker
+
+Simulations and optimizations need the Project (and usually a parset, progset and instructions) in
+every worker process. Sending these objects with every task would re-pickle them each time, so
+instead they are pickled once and unpickled once in each worker when it starts. Task functions then
+retrieve them with :func:`worker_data`.
+
+Workers are spawned rather than forked, because the pipeline may be running other stages in threads, and a
+process forked while another thread holds a lock (or is part-way through patching a function) can deadlock
+or inherit inconsistent state. Spawned workers import ``cascade_analyses`` and the calling script afresh, so
+task functions must be defined at module level, and scripts must only start pools under
+``if __name__ == "__main__":`` (as the analysis scripts do).
+
+"""
+
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import atomica as at
+
+__all__ = ["make_pool", "worker_data", "strip_results", "n_workers"]
+
+_worker = dict()  # Shared data in each worker process, set by _init_worker()
+
+
+def _init_worker(payload: bytes) -> None:
+    _worker.clear()
+    _worker.update(pickle.loads(payload))
+
+
+def worker_data() -> dict:
+    """
+    Return the shared data in a worker process
+
+    :return: A dict containing the keyword arguments that were passed to :func:`make_pool`
+
+    """
+
+    return _worker
+
+
+def make_pool(workers: int, **data) -> ProcessPoolExecutor:
+    """
+    Create a process pool with shared data
+
+    :param workers: Number of worker processes
+    :param data: Objects to make available in each worker via :func:`worker_data`
+    :return: A ``ProcessPoolExecutor``
+
+    """
+
+    payload = pickle.dumps(data)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker, initargs=(payload,))
+
+
+def strip_results(project: at.Project) -> at.Project:
+    """
+    Return a shallow copy of a project without its stored results
+
+    Workers do not need previously stored results, and they can be the bulk of a project's size.
+
+    :param project: A :class:`Project`
+    :return: A shallow copy of the project with an empty ``results`` collection
+
+    """
+
+    # Not copy.copy(), because Project.__setstate__ would make the copy share the original's __dict__, so that
+    # replacing the results (or settings) of the copy would also replace them in the original
+    light = object.__new__(type(project))
+    light.__dict__.update(project.__dict__)
+    light.results = type(project.results)()
+    return light
+
+
+def n_workers(workers: int, n_tasks: int) -> int:
+    """
+    Return the number of workers to use
+
+    :param workers: Requested number of workers, or ``None`` to use one per CPU
+    :param n_tasks: Number of tasks to run - no more workers than this are used
+    :return: Number of workers, at least 1
+
+    """
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return max(1, min(workers, n_tasks))
@@ -0,0 +1,198 @@
+"""
+Deferred plot rendering
+
+Plotting inline makes every stage wait while figures are drawn (and ``pl.show()`` waits until the windows
+are closed), and in batch runs on servers the figures just accumulate in memory. :class:`PlotQueue` instead
+takes a specification of each plot - which kind of plot, the results it shows, and its arguments such as
+the cascade, years and populations - and renders it to a file in a background process that uses a
+non-interactive backend. Simulations carry on while the plots are drawn, and no figures are kept in the
+analysis process.
+
+Typical usage::
+
+    with PlotQueue("plots") as plots:
+        plots.add("cascade", [unoptimized, optimized], cascade="HIV care cascade", year=[2022], name="optimized_cascade")
+        plots.add("programs", [optimized, unoptimized], t_bins=[2017, 2023])
+        ...  # Carries on immediately
+    print(plots.files)  # Leaving the block waits for all plots to be written
+
+The kinds of plot are the entries of :data:`PLOTS`. :func:`render_plot` draws the same specifications
+inline, for interactive use.
+
+"""
+
+import multiprocessing
+import os
+import pickle
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import atomica as at
+
+from .system import logger
+
+__all__ = ["PLOTS", "render_plot", "PlotQueue"]
+
+
+def _plot_programs(results, t_bins=None, year=None, stack_outputs="all"):
+    d = at.PlotData.programs(results, t_bins=t_bins)
+    if year is not None:
+        d.interpolate(year)
+    return at.plot_bars(d, stack_outputs=stack_outputs)
+
+
+def _plot_program_series(result, plot_type="stacked"):
+    return at.plot_series(at.PlotData.programs(result), plot_type=plot_type)
+
+
+#: Functions that draw each kind of plot, called with the positional and keyword arguments of the specification
+PLOTS = {
+    "cascade": at.plot_multi_cascade,  # Arguments of plot_multi_cascade(results, cascade, pops, year, data, ...)
+    "pop_cascade": at.plot_cascade,  # Arguments of plot_cascade(results, cascade, pops, year, data, ...)
+    "programs": _plot_programs,  # Program spending bars - results, t_bins and/or the year to interpolate to
+    "program_series": _plot_program_series,  # Program spending over time for one result
+}
+
+
+def render_plot(kind: str, *args, **kwargs) -> list:
+    """
+    Draw a plot in the current process
+
+    :param kind: Kind of plot, a key of :data:`PLOTS`
+    :param args: Positional arguments for the plotting function
+    :param kwargs: Keyword arguments for the plotting function
+    :return: List of the figures that were created
+
+    """
+
+    import pylab as pl
+
+    if kind not in PLOTS:
+        raise Exception(f'Unknown kind of plot "{kind}" - must be one of {list(PLOTS.keys())}')
+    before = set(pl.get_fignums())
+    PLOTS[kind](*args, **kwargs)
+    return [pl.figure(x) for x in pl.get_fignums() if x not in before]
+
+
+def _init_renderer(backend: str) -> None:
+    import matplotlib
+
+    matplotlib.use(backend)
+
+
+def _render(payload: bytes, path: str, fmt: str, dpi: int) -> list:
+    # Render one plot in the worker, saving each of its figures and then closing them
+    import pylab as pl
+
+    kind, args, kwargs = pickle.loads(payload)
+    try:
+        figs = render_plot(kind, *args, **kwargs)
+        files = []
+        for i, fig in enumerate(figs):
+            filename = f"{path}.{fmt}" if len(figs) == 1 else f"{path}_{i + 1}.{fmt}"
+            fig.savefig(filename, dpi=dpi, bbox_inches="tight")
+            files.append(filename)
+        return files
+    finally:
+        pl.close("all")
+
+
+class PlotQueue:
+    """
+    Render plots to files in a background process
+
+    The background process is started when the first plot is added. Each plot is pickled when it is added, so
+    it shows the results as they were at that point.
+
+    :param folder: Folder to write the plots to. It is created when the first plot is added
+    :param backend: Matplotlib backend for the background process - this should be a non-interactive backend
+    :param fmt: File format (and extension) of the plots, e.g. 'png', 'pdf' or 'svg'
+    :param dpi: Resolution of raster formats
+    :param workers: Number of background processes
+
+    """
+
+    def __init__(self, folder: str, backend: str = "Agg", fmt: str = "png", dpi: int = 150, workers: int = 1):
+        self.folder = folder
+        self.backend = backend
+        self.fmt = fmt
+        self.dpi = dpi
+        self.workers = workers
+        self.files = []  #: Files that have been written, in the order the plots were added
+        self.errors = []  #: ``(name, exception)`` for each plot that could not be rendered
+        self._pool = None
+        self._futures = []
+        self._count = 0
+        self._lock = threading.Lock()  # Stages in the pipeline's thread pool may add plots concurrently
+
+    def __repr__(self):
+        return f'<PlotQueue "{self.folder}" with {len(self._futures)} pending and {len(self.files)} written>'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, kind: str, *args, name: str = None, **kwargs) -> None:
+        """
+        Queue a plot
+
+        :param kind: Kind of plot, a key of :data:`PLOTS`
+        :param args: Positional arguments for the plotting function, e.g. the results
+        :param name: Name for the file, which is prefixed with a sequence number. By default, the kind of plot
+        :param kwargs: Keyword arguments for the plotting function, e.g. ``cascade``, ``year`` and ``pops``
+
+        """
+
+        if kind not in PLOTS:
+            raise Exception(f'Unknown kind of plot "{kind}" - must be one of {list(PLOTS.keys())}')
+
+        # Pickle here rather than leaving it to the pool's feeder thread, because pickling an Atomica result
+        # temporarily unlinks its model, which must not happen while this thread is still using the result
+        payload = pickle.dumps((kind, args, kwargs))
+        with self._lock:
+            if self._pool is None:
+                os.makedirs(self.folder, exist_ok=True)
+                # Spawn rather than fork, since the pipeline may be running other stages in threads
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_renderer, initargs=(self.backend,))
+            self._count += 1
+            label = f"{self._count:03d}_" + re.sub(r"[^\w\-.]+", "_", name or kind)
+            future = self._pool.submit(_render, payload, os.path.join(self.folder, label), self.fmt, self.dpi)
+            self._futures.append((label, future))
+
+    def wait(self) -> list:
+        """
+        Wait for all queued plots to be written
+
+        Plots that fail are logged and recorded in :attr:`errors` rather than raising an error, so that one bad
+        plot does not discard the rest.
+
+        :return: List of all files written so far
+
+        """
+
+        with self._lock:
+            futures, self._futures = self._futures, []
+        for label, future in futures:
+            try:
+                self.files.extend(future.result())
+            except Exception as E:
+                logger.warning('Plot "%s" could not be rendered: %s', label, E)
+                self.errors.append((label, E))
+        return self.files
+
+    def close(self) -> list:
+        """
+        Wait for all queued plots and stop the background process
+
+        :return: List of all files written
+
+        """
+
+        files = self.wait()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        return files
@@ -0,0 +1,190 @@
+"""
+Columnar result store
+
+Reading outputs from a :class:`Result` with ``result.get_variable()`` goes through the model's
+population and variable lookups on every call, and returns integration objects whose values then have
+to be stacked by hand. :class:`ResultStore` copies the values of a result once into a single
+``(variable, population, time)`` array with precomputed name indices, so that subsequent lookups are
+array indexing. Selecting a single variable (and optionally a single population) returns a view, with no copy.
+
+Typical usage::
+
+    store = ResultStore.from_result(result, variables=["num_acq", "num_hiv_deaths"])
+    store["num_acq"]                                    # Array (population, time)
+    store.get(["num_acq", "num_hiv_deaths"], "adults")  # Array (variable, time)
+    stack_stores([store1, store2], "num_acq").sum(axis=1)  # Array (result, time) with totals over populations
+
+Variables that are not present in a population (e.g. because it has a different population type) are NaN.
+
+"""
+
+import numpy as np
+import atomica as at
+import sciris as sc
+
+__all__ = ["ResultStore", "stack_stores"]
+
+
+class ResultStore:
+    """
+    Values of many variables in a result, stored as one array
+
+    Normally constructed with :meth:`ResultStore.from_result`.
+
+    :param name: Name of the result
+    :param t: Array of simulation times
+    :param variables: List of variable code names, in the order of the first axis of ``data``
+    :param pops: List of population code names, in the order of the second axis of ``data``
+    :param data: Array with shape ``(len(variables), len(pops), len(t))``
+
+    """
+
+    def __init__(self, name: str, t, variables: list, pops: list, data: np.ndarray):
+        self.name = name
+        self.t = np.asarray(t)
+        self.variables = list(variables)
+        self.pops = list(pops)
+        self.data = data
+        if self.data.shape != (len(self.variables), len(self.pops), len(self.t)):
+            raise Exception(f"Data has shape {self.data.shape} but the store has {len(self.variables)} variables, {len(self.pops)} populations and {len(self.t)} time points")
+        self.var_index = {x: i for i, x in enumerate(self.variables)}  #: Maps variable name to index in the first axis
+        self.pop_index = {x: i for i, x in enumerate(self.pops)}  #: Maps population name to index in the second axis
+
+    @classmethod
+    def from_result(cls, result: at.Result, variables: list = None, pops: list = None, dtype=float):
+        """
+        Make a store from a result
+
+        Links are stored by their code name (e.g. ``'inf_rate:flow'``), summed over all links with that name in the population.
+
+        :param result: A :class:`Result`
+        :param variables: Optionally specify a list of variable code names to store. By default, all compartments,
+                          characteristics, parameters and links in the result are stored
+        :param pops: Optionally specify a list of population code names to store. By default, all populations are stored
+        :param dtype: Data type of the stored values
+        :return: A new :class:`ResultStore`
+
+        """
+
+        model_pops = [result.model.get_pop(x) for x in sc.promotetolist(pops)] if pops is not None else list(result.model.pops)
+        if variables is None:
+            variables = []
+            for pop in model_pops:
+                for name in list(pop.comp_lookup) + list(pop.charac_lookup) + list(pop.par_lookup) + list(pop.link_lookup):
+                    if name not in variables:
+                        variables.append(name)
+        else:
+            variables = sc.promotetolist(variables)
+
+        data = np.full((len(variables), len(model_pops), len(result.t)), np.nan, dtype=dtype)
+        for j, pop in enumerate(model_pops):
+            for i, name in enumerate(variables):
+                try:
+                    objs = pop.get_variable(name)
+                except at.NotFoundError:
+                    continue
+                if len(objs) == 1:
+                    if objs[0].vals is not None:
+                        data[i, j] = objs[0].vals
+                elif objs:
+                    data[i, j] = np.sum([x.vals for x in objs], axis=0)  # Duplicate links are summed
+        return cls(result.name, result.t, variables, [x.name for x in model_pops], data)
+
+    def __repr__(self):
+        return f'<ResultStore "{self.name}" {len(self.variables)} variables, {len(self.pops)} pops, {len(self.t)} time points>'
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self.get(*key)
+        return self.get(key)
+
+    def __contains__(self, name):
+        return name in self.var_index
+
+    @staticmethod
+    def _lookup(keys, index: dict, kind: str):
+        # Convert names into an index for one axis - an integer for a single name, a slice if possible, or an array
+        if keys is None:
+            return slice(None)
+        try:
+            if sc.isstring(keys):
+                return index[keys]
+            idx = [index[x] for x in keys]
+        except KeyError as E:
+            raise at.NotFoundError(f'{kind} {E} is not in the store') from None
+        if idx and idx == list(range(idx[0], idx[-1] + 1)):
+            return slice(idx[0], idx[-1] + 1)  # Contiguous names are returned as a view
+        return np.array(idx, dtype=int)
+
+    def get(self, variables=None, pops=None) -> np.ndarray:
+        """
+        Return values for one or more variables and populations
+
+        A single name for either argument drops that axis. Single names, and lists of names that are
+        adjacent in the store, return a view of the store rather than a copy, so modifying the returned
+        array modifies the store.
+
+        :param variables: A variable name, a list of names, or ``None`` for all variables
+        :param pops: A population name, a list of names, or ``None`` for all populations
+        :return: Array with axes (variable, population, time), excluding the axes where a single name was given
+
+        """
+
+        i = self._lookup(variables, self.var_index, "Variable")
+        j = self._lookup(pops, self.pop_index, "Population")
+        if isinstance(i, np.ndarray) and isinstance(j, np.ndarray):
+            return self.data[np.ix_(i, j)]
+        return self.data[i, j]
+
+    def subset(self, variables: list = None, pops: list = None):
+        """
+        Return a new store containing a subset of the variables and populations
+
+        :param variables: Optionally specify a list of variable names to keep. By default, all variables are kept
+        :param pops: Optionally specify a list of population names to keep. By default, all populations are kept
+        :return: A new :class:`ResultStore` with a copy of the selected data
+
+        """
+
+        variables = sc.promotetolist(variables) if variables is not None else self.variables
+        pops = sc.promotetolist(pops) if pops is not None else self.pops
+        return ResultStore(self.name, self.t, variables, pops, np.array(self.get(variables, pops)))
+
+    def total(self, variables=None, pops=None) -> np.ndarray:
+        """
+        Return values summed over populations
+
+        Populations where a variable is not present are ignored.
+
+        :param variables: A variable name, a list of names, or ``None`` for all variables
+        :param pops: A population name, a list of names, or ``None`` for all populations
+        :return: Array with axes (variable, time), or (time) if a single variable name was given
+
+        """
+
+        return np.nansum(self.get(variables, sc.promotetolist(pops) if pops is not None else None), axis=-2)
+
+
+def stack_stores(stores: list, variables=None, pops=None) -> np.ndarray:
+    """
+    Stack the same selection from several stores
+
+    Values are selected by name in every store, so the stores can hold their variables and populations in
+    different orders - e.g. results made in worker processes, where the model's lookups may be ordered differently.
+
+    :param stores: List of :class:`ResultStore` instances with the same time points
+    :param variables: A variable name, a list of names, or ``None`` for all variables in the first store (which must then be in every store)
+    :param pops: A population name, a list of names, or ``None`` for all populations in the first store (which must then be in every store)
+    :return: Array with a leading result axis, followed by the axes returned by :meth:`ResultStore.get`
+
+    """
+
+    stores = sc.promotetolist(stores)
+    if variables is None:
+        variables = stores[0].variables
+    if pops is None:
+        pops = stores[0].pops
+    for store in stores[1:]:
+        if len(store.t) != len(stores[0].t) or not np.allclose(store.t, stores[0].t):
+            raise Exception(f'Store "{store.name}" has different time points to "{stores[0].name}"')
+    return np.stack([x.get(variables, pops) for x in stores])
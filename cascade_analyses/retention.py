@@ -0,0 +1,232 @@
+"""
+Memory-lean retention of stored results
+
+``run_sim(..., store_results=True)`` keeps every result in ``project.results``, and each result holds the
+whole model - every compartment, characteristic, parameter and link in every population, plus copies of the
+framework and progset - even though the analyses only read a few variables from most of them. Over a long
+session of scenarios and optimizations, this grows without bound.
+
+:func:`retain_results` replaces ``project.results`` with a :class:`RetainedResults` collection, which keeps
+only the most recently stored (or used) results in full. Older results are reduced to a
+:class:`RetainedResult`, which holds a :class:`ResultStore` of the declared variables and populations
+(optionally as float32) and what is needed to run the simulation again. The full result is available on
+demand by re-running it::
+
+    retain_results(P, variables=["num_acq", "num_hiv_deaths", "all_people"], dtype=np.float32, max_full=2, max_results=50)
+    P.run_sim(parset="default", result_name="baseline", store_results=True)
+    ...
+    P.results["baseline"].store["num_acq"]    # Always available, from the retained variables
+    P.results.full("baseline")                # The full at.Result, re-run if it was reduced
+
+Re-running uses the project's framework and its parset (and progset, if it is stored in the project) with the
+same name, so it reproduces the original result as long as those have not been changed since.
+
+"""
+
+import atomica as at
+import numpy as np
+import sciris as sc
+
+from .results import ResultStore
+from .system import logger
+
+__all__ = ["RetainedResult", "RetainedResults", "retain_results"]
+
+
+class RetainedResult:
+    """
+    Selected values of a result that is no longer kept in full
+
+    :param result: The :class:`Result` to reduce
+    :param project: The :class:`Project` the result was stored in
+    :param variables: Variable code names to keep. By default, all variables are kept
+    :param pops: Population code names to keep. By default, all populations are kept
+    :param dtype: Data type of the kept values
+
+    """
+
+    def __init__(self, result: at.Result, project: at.Project, variables: list = None, pops: list = None, dtype=float):
+        self.name = result.name
+        self.store = ResultStore.from_result(result, variables=variables, pops=pops, dtype=dtype)  #: The retained values
+        self.parset_name = result.parset_name
+        self.settings = sc.dcp(project.settings)
+        self.instructions = result.model.program_instructions
+        progset = result.model.progset
+        if progset is None or progset.name in project.progsets:
+            self.progset = progset.name if progset is not None else None  # Re-run with the project's progset with this name
+        else:
+            self.progset = progset  # Not stored in the project, so keep the model's copy
+
+    def __repr__(self):
+        return f'<RetainedResult "{self.name}" {len(self.store.variables)} variables, {self.store.data.nbytes / 1e6:.2f} MB>'
+
+    @property
+    def t(self) -> np.ndarray:
+        return self.store.t
+
+    def rerun(self, project: at.Project) -> at.Result:
+        """
+        Run the simulation again to recover the full result
+
+        :param project: The :class:`Project` the result was stored in
+        :return: A new :class:`Result` with the same name
+
+        """
+
+        if self.parset_name not in project.parsets:
+            raise Exception(f'Result "{self.name}" cannot be re-run because its parset "{self.parset_name}" is not in the project')
+        progset = project.progsets[self.progset] if sc.isstring(self.progset) else self.progset
+        return at.run_model(settings=self.settings, framework=project.framework, parset=project.parsets[self.parset_name], progset=progset, program_instructions=self.instructions, name=self.name)
+
+
+class RetainedResults(at.NDict):
+    """
+    Collection of results that keeps only the most recent results in full
+
+    Results are stored and retrieved by name as in ``project.results``. Retrieving a result that is kept in
+    full counts as using it. Results that are not kept in full are returned as :class:`RetainedResult`
+    instances - use :meth:`full` to get the :class:`Result`.
+
+    :param project: The :class:`Project` the results belong to, used to re-run results
+    :param variables: Variable code names to retain from results that are not kept in full. By default, all variables
+    :param pops: Population code names to retain. By default, all populations
+    :param dtype: Data type of the retained values, e.g. ``np.float32`` to halve their size
+    :param max_full: Maximum number of results to keep in full. If ``None``, results are never reduced
+    :param max_results: Maximum number of results to keep at all. The oldest results are removed. If ``None``, there is no limit
+    :param order: 'lru' to reduce and remove the least recently used results first, or 'fifo' for the least recently stored
+
+    """
+
+    def __init__(self, project: at.Project = None, variables: list = None, pops: list = None, dtype=float, max_full: int = None, max_results: int = None, order: str = "lru"):
+        super().__init__()
+        if order not in {"lru", "fifo"}:
+            raise Exception(f'Unknown retention order "{order}" - must be "lru" or "fifo"')
+        self.project = project
+        self.variables = sc.promotetolist(variables) if variables is not None else None
+        self.pops = sc.promotetolist(pops) if pops is not None else None
+        self.dtype = np.dtype(dtype)
+        self.max_full = max_full
+        self.max_results = max_results
+        self.order = order
+        self.reruns = 0  #: Number of results that have been re-run by :meth:`full`
+        self._usage = []  # Names from least to most recently used (or stored)
+
+    def __repr__(self):
+        n_full = sum(isinstance(x, at.Result) for x in self._values())
+        return f"<RetainedResults {n_full} full and {len(self) - n_full} retained (max_full={self.max_full}, max_results={self.max_results}, order={self.order})>"
+
+    def _values(self) -> list:
+        return [dict.__getitem__(self, x) for x in self.keys()]
+
+    def _touch(self, name: str) -> None:
+        if name in self._usage:
+            self._usage.remove(name)
+        self._usage.append(name)
+
+    def __setitem__(self, key, item):
+        super().__setitem__(key, item)
+        if sc.isstring(key) and hasattr(self, "_usage"):  # When unpickling, items are restored before the attributes
+            self._touch(key)
+            self._enforce()
+
+    def __getitem__(self, key):
+        item = super().__getitem__(key)
+        if getattr(self, "order", None) == "lru" and isinstance(item, at.Result) and item.name in self._usage:
+            self._touch(item.name)
+        return item
+
+    def __delitem__(self, key):
+        name = self.keys()[key] if isinstance(key, int) else key
+        super().__delitem__(key)
+        if name in getattr(self, "_usage", []):
+            self._usage.remove(name)
+
+    def _enforce(self) -> None:
+        # Remove the oldest results beyond max_results, then reduce the oldest full results beyond max_full
+        names = set(self.keys())
+        self._usage = [x for x in self._usage if x in names] + [x for x in self.keys() if x not in self._usage]
+        while self.max_results is not None and len(self._usage) > self.max_results:
+            name = self._usage.pop(0)
+            super().__delitem__(name)
+            logger.debug('Removed result "%s"', name)
+        if self.max_full is not None:
+            full = [x for x in self._usage if isinstance(dict.__getitem__(self, x), at.Result)]
+            for name in full[: max(0, len(full) - self.max_full)]:
+                self.reduce(name)
+
+    def reduce(self, name: str) -> RetainedResult:
+        """
+        Replace a full result with its retained values
+
+        :param name: Name of the result
+        :return: The :class:`RetainedResult` that replaces it
+
+        """
+
+        item = dict.__getitem__(self, name)
+        if isinstance(item, at.Result):
+            if self.project is None:
+                raise Exception("Results can only be reduced if the collection has a project, so that they can be re-run")
+            item = RetainedResult(item, self.project, variables=self.variables, pops=self.pops, dtype=self.dtype)
+            super().__setitem__(name, item)
+            logger.debug("Reduced %s", item)
+        return item
+
+    def full(self, key) -> at.Result:
+        """
+        Return a full result, re-running it if it has been reduced
+
+        The re-run result is stored in full again, which counts as using it.
+
+        :param key: Name or index of the result
+        :return: A :class:`Result`
+
+        """
+
+        item = super().__getitem__(key)
+        if isinstance(item, RetainedResult):
+            logger.info('Re-running result "%s", which was not kept in full', item.name)
+            item = item.rerun(self.project)
+            self.reruns += 1
+            self[item.name] = item
+        elif item.name in self._usage:
+            self._touch(item.name)
+        return item
+
+    def stores(self, keys: list = None) -> list:
+        """
+        Return the retained values of results without re-running them
+
+        :param keys: Names or indices of results. By default, all results
+        :return: List of :class:`ResultStore` instances. For results that are kept in full, a store is made with the retained variables and populations
+
+        """
+
+        items = [super(RetainedResults, self).__getitem__(x) for x in (sc.promotetolist(keys) if keys is not None else self.keys())]
+        return [x.store if isinstance(x, RetainedResult) else ResultStore.from_result(x, variables=self.variables, pops=self.pops, dtype=self.dtype) for x in items]
+
+
+def retain_results(project: at.Project, variables: list = None, pops: list = None, dtype=float, max_full: int = None, max_results: int = None, order: str = "lru") -> RetainedResults:
+    """
+    Apply a retention policy to a project's results
+
+    The project's ``results`` are replaced by a :class:`RetainedResults` collection containing its existing
+    results, and the limits are applied immediately.
+
+    :param project: A :class:`Project`
+    :param variables: Variable code names to retain from results that are not kept in full. By default, all variables
+    :param pops: Population code names to retain. By default, all populations
+    :param dtype: Data type of the retained values, e.g. ``np.float32`` (or "float32")
+    :param max_full: Maximum number of results to keep in full. If ``None``, results are never reduced
+    :param max_results: Maximum number of results to keep at all. If ``None``, there is no limit
+    :param order: 'lru' or 'fifo', the order in which results are reduced and removed
+    :return: The new collection, which is also ``project.results``
+
+    """
+
+    results = RetainedResults(project, variables=variables, pops=pops, dtype=dtype, max_full=max_full, max_results=max_results, order=order)
+    for name in project.results.keys():
+        sc.odict.__setitem__(results, name, project.results[name])
+    results._enforce()
+    project.results = results
+    return results
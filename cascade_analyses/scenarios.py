@@ -0,0 +1,145 @@
+"""
+Parallel budget-scenario sweeps
+
+Budget scenarios are independent simulations of the same parset and progset with different
+:class:`ProgramInstructions`, so they can be farmed out to a process pool. Each worker process
+receives the Project once, when it starts, and then runs whichever scenarios it is handed.
+Results are returned in the same order as the instructions that were passed in, and are
+identical to calling ``Project.run_sim()`` for each scenario in turn.
+
+Typical usage::
+
+    default_budget = at.ProgramInstructions(start_year=2016, alloc=P.progsets[0])
+    variants = budget_variants(default_budget, [0.5, 1, 1.5, 2])
+    results = run_scenarios(P, variants, workers=4, writer=ResultWriter("budget_sweep"))  # Optionally stream results to disk
+
+With ``warm_start=True``, the years before the programs start are simulated once for each start year (see
+:class:`Checkpoint`) and every scenario resumes from there.
+
+"""
+
+import atomica as at
+import sciris as sc
+
+from .parallel import make_pool, worker_data, strip_results, n_workers
+from .system import logger
+from .warmstart import Checkpoint
+
+__all__ = ["scale_instructions", "budget_variants", "run_scenarios"]
+
+
+def scale_instructions(instructions: at.ProgramInstructions, factor: float, programs: list = None) -> at.ProgramInstructions:
+    """
+    Return a copy of program instructions with spending multiplied by a constant
+
+    :param instructions: The :class:`ProgramInstructions` to scale
+    :param factor: Multiplicative factor applied to spending at all time points
+    :param programs: Optionally specify a list of program names to scale. By default, all programs are scaled
+    :return: A new :class:`ProgramInstructions` instance
+
+    """
+
+    if factor < 0:
+        raise Exception("Cannot scale spending by a negative factor")
+    new = sc.dcp(instructions)
+    for prog_name, ts in new.alloc.items():
+        if programs is None or prog_name in programs:
+            ts.vals = [x * factor for x in ts.vals]
+            ts.assumption = ts.assumption * factor if ts.assumption is not None else None
+    return new
+
+
+def budget_variants(instructions: at.ProgramInstructions, factors: list, programs=None) -> sc.odict:
+    """
+    Make a grid of scaled budgets
+
+    :param instructions: The :class:`ProgramInstructions` containing the reference allocation
+    :param factors: List of multipliers to apply
+    :param programs: If ``None``, every factor is applied to all programs at once. If ``'each'``, every factor is applied to each
+                     program in ``instructions.alloc`` individually. Alternatively, a list of program names to apply factors to individually
+    :return: An ``sc.odict`` of :class:`ProgramInstructions` keyed by scenario name (e.g. ``'x2'`` or ``'PMTCT x2'``)
+
+    """
+
+    variants = sc.odict()
+    if programs is None:
+        for factor in factors:
+            variants[f"x{factor:g}"] = scale_instructions(instructions, factor)
+    else:
+        if programs == "each":
+            programs = list(instructions.alloc.keys())
+        for prog_name in programs:
+            for factor in factors:
+                variants[f"{prog_name} x{factor:g}"] = scale_instructions(instructions, factor, programs=[prog_name])
+    return variants
+
+
+def _run_scenario(args: tuple) -> at.Result:
+    instructions, result_name = args
+    data = worker_data()
+    return _run_one(data["project"], data["parset"], data["progset"], instructions, result_name, data["checkpoints"])
+
+
+def _run_one(project, parset, progset, instructions, result_name, checkpoints=None):
+    # Run a single scenario - shared by the serial and parallel code paths so that they give identical results
+    if checkpoints and instructions is not None:
+        return checkpoints[instructions.start_year].run(instructions, name=result_name)
+    return project.run_sim(parset=parset, progset=progset if instructions is not None else None, progset_instructions=instructions, result_name=result_name)
+
+
+def run_scenarios(project: at.Project, instructions, parset="default", progset="default", result_names: list = None, workers: int = None, store_results: bool = False, writer=None, warm_start: bool = False) -> list:
+    """
+    Run many budget scenarios in parallel
+
+    :param project: The :class:`Project` to simulate. Its settings, parsets and progsets are sent to each worker once
+    :param instructions: A list of :class:`ProgramInstructions`, or an ``sc.odict`` of them keyed by result name.
+                         A ``None`` entry runs the parset without programs
+    :param parset: Name of the parset to use (or a :class:`ParameterSet` instance)
+    :param progset: Name of the progset to use (or a :class:`ProgramSet` instance)
+    :param result_names: Optionally specify a name for each result. By default, the keys of ``instructions`` if it is a dict, otherwise ``'scenario_<n>'``
+    :param workers: Number of worker processes. If ``None``, use one per CPU (up to the number of scenarios). With 1 worker, scenarios are run serially in this process
+    :param store_results: If True, append the results to ``project.results`` in input order
+    :param writer: Optionally specify a :class:`ResultWriter`. Each result is written to it as soon as it is returned
+    :param warm_start: If True, resume scenarios with programs from a :class:`Checkpoint` at their program start year, made once per start year
+    :return: List of :class:`Result` instances, in the same order as ``instructions``
+
+    """
+
+    if isinstance(instructions, dict):
+        if result_names is None:
+            result_names = list(instructions.keys())
+        instructions = list(instructions.values())
+    else:
+        instructions = sc.promotetolist(instructions, keepnone=True)
+    if result_names is None:
+        result_names = [f"scenario_{i}" for i in range(len(instructions))]
+    if len(result_names) != len(instructions):
+        raise Exception(f"{len(result_names)} result names were provided for {len(instructions)} scenarios")
+
+    # Resolve names to objects now, so that the parset and progset can be sent to each worker once
+    parset = project.parset(parset)
+    progset = project.progset(progset) if any(x is not None for x in instructions) else None
+    tasks = list(zip(instructions, result_names))
+    checkpoints = {x: Checkpoint(project, x, parset=parset, progset=progset) for x in sorted({x.start_year for x in instructions if x is not None})} if warm_start else None
+
+    workers = n_workers(workers, len(tasks))
+
+    tm = sc.tic()
+    results = []
+    if workers == 1:
+        for instr, name in tasks:
+            results.append(_run_one(project, parset, progset, instr, name, checkpoints))
+            if writer is not None:
+                writer.write(results[-1])
+    else:
+        with make_pool(workers, project=strip_results(project), parset=parset, progset=progset, checkpoints=checkpoints) as pool:
+            for result in pool.map(_run_scenario, tasks):
+                results.append(result)
+                if writer is not None:
+                    writer.write(result)
+    logger.info("Ran %d scenarios with %d worker(s) in %.2fs", len(results), workers, sc.toc(tm, output=True))
+
+    if store_results:
+        for result in results:
+            project.results.append(result)
+    return results
@@ -0,0 +1,308 @@
+"""
+Dependency-aware stage runner for the analysis scripts
+
+Each analysis is a sequence of named stages ('loadframework', 'makeparset', 'runsim', 'optimize' etc.).
+Rather than maintaining a hand-edited list of every stage to execute, a script registers its stages
+with a :class:`Pipeline` and then asks for the stages it actually wants. The pipeline
+
+- adds any upstream stages the requested ones depend on,
+- skips stages whose declared output files are newer than their input files,
+- runs stages that do not depend on each other concurrently, and
+- records how long each stage took.
+
+The dependencies between the standard stages are defined in :data:`STAGES`, so scripts only
+need to supply the function for each stage.
+
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import atomica as at
+import sciris as sc
+
+from .retention import RetainedResults, retain_results
+from .system import logger
+
+__all__ = ["STAGES", "Stage", "Pipeline", "add_build_stages"]
+
+#: Standard stages and the stages that each one requires
+STAGES = sc.odict(
+    [
+        ("loadframework", []),
+        ("makedatabook", ["loadframework"]),
+        ("makeproject", ["loadframework"]),
+        ("loaddatabook", ["makeproject"]),
+        ("makeparset", ["loaddatabook"]),
+        ("runsim", ["makeparset"]),
+        ("calibrate", ["makeparset"]),
+        ("plotcascade", ["runsim"]),
+        ("makeblankprogbook", ["loaddatabook"]),
+        ("loadprogbook", ["makeparset"]),
+        ("reconcile", ["loadprogbook"]),
+        ("runsim_programs", ["loadprogbook"]),
+        ("budget_scenarios", ["loadprogbook"]),
+        ("optimize", ["loadprogbook"]),
+    ]
+)
+
+
+class Stage:
+    """
+    A single unit of work in a :class:`Pipeline`
+
+    :param name: Name of the stage
+    :param func: Function to run. It is called with the pipeline's context as its only argument.
+                 It may return a string, which is recorded as the stage's status (e.g. 'cached')
+    :param requires: List of names of stages that must be completed before this one
+    :param inputs: List of files that the stage reads
+    :param outputs: List of files that the stage writes. If all of them exist and are newer than all of the
+                    inputs, the stage is up to date and will be skipped
+    :param main_thread: If True, the stage is always run in the main thread (required for stages that plot)
+
+    """
+
+    def __init__(self, name: str, func, requires: list = None, inputs: list = None, outputs: list = None, main_thread: bool = False):
+        self.name = name
+        self.func = func
+        self.requires = sc.promotetolist(requires)
+        self.inputs = sc.promotetolist(inputs)
+        self.outputs = sc.promotetolist(outputs)
+        self.main_thread = main_thread
+
+    def __repr__(self):
+        return f'<Stage "{self.name}" requires={self.requires}>'
+
+    def is_current(self) -> bool:
+        """
+        Check whether the stage's outputs are up to date
+
+        :return: True if the stage declares outputs and they are all newer than every input
+
+        """
+
+        if not self.outputs or not all(os.path.exists(x) for x in self.outputs):
+            return False
+        newest_input = max((os.path.getmtime(x) for x in self.inputs if os.path.exists(x)), default=0)
+        return min(os.path.getmtime(x) for x in self.outputs) >= newest_input
+
+
+class Pipeline:
+    """
+    Collection of stages with dependencies
+
+    Stages are registered with :meth:`add` or the :meth:`stage` decorator and executed with :meth:`run`.
+    Stage functions share state through :attr:`context`, an ``sc.objdict`` (so for example the Project
+    is available as ``ctx.P`` once it has been loaded).
+
+    :param context: Optionally provide initial entries for the shared context
+
+    """
+
+    def __init__(self, context: dict = None):
+        self.stages = sc.odict()
+        self.context = sc.objdict(context if context is not None else {})
+        self.timings = sc.odict()  #: After running, the status and wall time of every stage that was considered
+        self.instrumentation = None  #: Optionally an active :class:`Instrumentation`, which records each stage that is run
+
+    def add(self, name: str, func, requires: list = None, **kwargs) -> Stage:
+        """
+        Register a stage
+
+        :param name: Name of the stage. If it is one of the standard stages in :data:`STAGES`, its
+                     dependencies are used by default
+        :param func: Function to run, called with the pipeline context
+        :param requires: List of stage names this stage depends on, overriding :data:`STAGES`
+        :param kwargs: Other arguments passed to :class:`Stage`
+        :return: The new :class:`Stage`
+
+        """
+
+        if requires is None:
+            requires = STAGES[name] if name in STAGES else []
+        self.stages[name] = Stage(name, func, requires=requires, **kwargs)
+        return self.stages[name]
+
+    def stage(self, name: str, **kwargs):
+        """
+        Decorator form of :meth:`add`
+
+        Example usage::
+
+            @pipeline.stage("runsim")
+            def runsim(ctx):
+                ctx.P.run_sim(parset="default", result_name="default", store_results=True)
+
+        """
+
+        def decorator(func):
+            self.add(name, func, **kwargs)
+            return func
+
+        return decorator
+
+    def resolve(self, targets: list) -> list:
+        """
+        Return the stages needed to produce the targets
+
+        :param targets: List of stage names
+        :return: List of stage names, including all dependencies, in an order consistent with the dependencies
+
+        """
+
+        order = []
+        visiting = set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name not in self.stages:
+                raise Exception(f'Stage "{name}" has not been added to the pipeline (available stages are {self.stages.keys()})')
+            if name in visiting:
+                raise Exception(f'Circular dependency involving stage "{name}"')
+            visiting.add(name)
+            for dep in self.stages[name].requires:
+                visit(dep)
+            visiting.remove(name)
+            order.append(name)
+
+        for target in sc.promotetolist(targets):
+            visit(target)
+        return order
+
+    def run(self, targets: list, workers: int = 1, force: list = None) -> sc.odict:
+        """
+        Run stages
+
+        Stages are started as soon as all of their dependencies have completed. With more than one worker,
+        independent stages run concurrently in a thread pool, except for stages flagged ``main_thread``, which
+        always run in the calling thread while the pool keeps working.
+
+        :param targets: List of stage names to run. Their dependencies are added automatically
+        :param workers: Maximum number of stages to run at the same time
+        :param force: List of stage names to run even if their outputs are up to date, or True to force all stages
+        :return: A dict keyed by stage name, containing the status ('ran', 'skipped' or a status returned by the stage) and time in seconds
+
+        """
+
+        order = self.resolve(targets)
+        force = set(order) if force is True else set(sc.promotetolist(force))
+        pending = list(order)
+        done = set()
+        self.timings = sc.odict()
+        lock = threading.Lock()
+
+        def execute(name):
+            stage = self.stages[name]
+            start = time.perf_counter()
+            if name not in force and stage.is_current():
+                status = "skipped"
+            elif self.instrumentation is not None:
+                with self.instrumentation.stage(name):
+                    status = stage.func(self.context) or "ran"
+            else:
+                status = stage.func(self.context) or "ran"
+            elapsed = time.perf_counter() - start
+            with lock:
+                self.timings[name] = sc.objdict(status=status, time=elapsed)
+            logger.info('Stage "%s" %s in %.2fs', name, status, elapsed)
+            return name
+
+        def ready():
+            return [x for x in pending if all(dep in done for dep in self.stages[x].requires)]
+
+        tm = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            running = {}
+            while pending or running:
+                for name in ready():
+                    pending.remove(name)
+                    if workers > 1 and not self.stages[name].main_thread:
+                        running[pool.submit(execute, name)] = name
+                    else:
+                        # Run in this thread - any stages already submitted to the pool continue in the meantime
+                        done.add(execute(name))
+                        break  # Re-check readiness, since completing this stage may unblock others
+                else:
+                    if running:
+                        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            del running[future]
+                            done.add(future.result())  # Re-raises any exception from the stage
+                    elif pending:
+                        raise Exception(f"Unable to schedule stages {pending}")  # Should not happen if resolve() succeeded
+
+        logger.info("Pipeline completed in %.2fs\n%s", time.perf_counter() - tm, self.report())
+        return self.timings
+
+    def report(self) -> str:
+        """
+        Return a table of stage timings from the most recent run
+
+        :return: Multi-line string with one row per stage
+
+        """
+
+        width = max([len(x) for x in self.timings.keys()], default=5)
+        lines = [f"{'Stage':<{width}}  {'Status':<8}  Time (s)"]
+        for name, timing in self.timings.items():
+            lines.append(f"{name:<{width}}  {timing.status:<8}  {timing.time:8.2f}")
+        return "\n".join(lines)
+
+
+def add_build_stages(pipeline: Pipeline, cache, settings: dict = None, databook_args: dict = None, blank_databook: str = None, blank_progbook: str = None, progs=None, retention: dict = None) -> None:
+    """
+    Register the standard project-building stages
+
+    The 'loadframework', 'makeproject', 'loaddatabook', 'makeparset' and 'loadprogbook' stages are served by a
+    :class:`ProjectCache`, so they only parse spreadsheets when those have changed (in which case their status is
+    'built', otherwise 'cached'). The Project is stored in the pipeline context as ``ctx.P`` and the framework as ``ctx.F``.
+
+    :param pipeline: The :class:`Pipeline` to add stages to
+    :param cache: A :class:`ProjectCache` for the analysis
+    :param settings: Optionally provide a dict of arguments for ``Project.update_settings()``, applied after the parset is made
+    :param databook_args: Arguments for ``Project.create_databook()``. If provided, a 'makedatabook' stage is added
+    :param blank_databook: File name for the blank databook written by 'makedatabook'
+    :param blank_progbook: File name for the blank progbook. If provided, a 'makeblankprogbook' stage is added
+    :param progs: Program specification for ``Project.make_progbook()``
+    :param retention: Optionally provide a dict of arguments for :func:`retain_results`, applied to the project's results
+
+    """
+
+    def from_cache(level):
+        def func(ctx):
+            with cache.lock:
+                status = "cached" if level in cache.status or cache.is_cached(level) else "built"
+                ctx.P = cache.get(level)
+            ctx.F = ctx.P.framework
+            if retention is not None and not isinstance(ctx.P.results, RetainedResults):
+                retain_results(ctx.P, **retention)
+            if level == "parset" and settings:
+                ctx.P.update_settings(**settings)
+            return status
+
+        return func
+
+    pipeline.add("loadframework", from_cache("framework"), inputs=cache.paths["framework"])
+    pipeline.add("makeproject", from_cache("framework"))
+    pipeline.add("loaddatabook", from_cache("databook"), inputs=cache.paths["databook"])
+    pipeline.add("makeparset", from_cache("parset"))
+    if cache.paths["progbook"] is not None:
+        pipeline.add("loadprogbook", from_cache("progbook"), inputs=cache.paths["progbook"])
+
+    if databook_args is not None:
+
+        def makedatabook(ctx):
+            P = at.Project(framework=ctx.F)  # Create a project with an empty data structure based on the model framework
+            P.create_databook(databook_path=blank_databook, **databook_args)
+
+        pipeline.add("makedatabook", makedatabook, inputs=cache.paths["framework"], outputs=blank_databook)
+
+    if blank_progbook is not None:
+
+        def makeblankprogbook(ctx):
+            ctx.P.make_progbook(blank_progbook, progs=progs)
+
+        pipeline.add("makeblankprogbook", makeblankprogbook, inputs=[cache.paths["framework"], cache.paths["databook"]], outputs=blank_progbook)
@@ -0,0 +1,81 @@
+"""
+Logging and other module-wide settings
+"""
+
+import contextlib
+import functools
+import logging
+import threading
+
+# Log through a child of the atomica logger so that messages share atomica's handlers and level
+logger = logging.getLogger("atomica").getChild("cascade_analyses")
+
+
+class _Patch:
+    # An attribute that is replaced by a dispatcher while any handlers are installed for it
+    def __init__(self, obj, attr: str):
+        self.obj = obj
+        self.attr = attr
+        self.original = getattr(obj, attr)
+        self.shared = []  # Handlers that apply in every thread
+        self.local = threading.local()  # Handlers that apply only in the thread that installed them
+        self.users = 0
+
+        original = self.original
+
+        @functools.wraps(original)
+        def dispatcher(*args, **kwargs):
+            # The outermost handler is called first, with a function that calls the next one
+            call = original
+            for handler in self.shared + getattr(self.local, "handlers", []):
+                call = functools.partial(handler, call)
+            return call(*args, **kwargs)
+
+        self.dispatcher = dispatcher
+
+
+_patches = dict()  # Maps (id(obj), attr) to the _Patch of each patched attribute
+_patch_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def patched(obj, attr: str, handler, shared: bool = False):
+    """
+    Route calls to a function attribute through a handler
+
+    The attribute is replaced by a dispatcher the first time any handler is installed for it, and restored
+    when the last one is removed, so handlers can be installed and removed in any order and from several
+    threads. The handler is called as ``handler(call, *args, **kwargs)``, where ``call`` calls the next
+    handler - or the original function - with whatever arguments it is given.
+
+    :param obj: The module or class with the attribute
+    :param attr: Name of the attribute
+    :param handler: Function to route calls through
+    :param shared: If True, the handler applies to calls from every thread. Otherwise, it only applies to calls
+                   from the thread that installed it. Handlers installed later are called first
+
+    """
+
+    key = (id(obj), attr)
+    with _patch_lock:
+        if key not in _patches:
+            _patches[key] = _Patch(obj, attr)
+            setattr(obj, attr, _patches[key].dispatcher)
+        patch = _patches[key]
+        patch.users += 1
+        if shared:
+            patch.shared.append(handler)
+        else:
+            if not hasattr(patch.local, "handlers"):
+                patch.local.handlers = []
+            patch.local.handlers.append(handler)
+    try:
+        yield
+    finally:
+        with _patch_lock:
+            handlers = patch.shared if shared else patch.local.handlers
+            handlers.remove(next(x for x in handlers if x is handler))  # By identity, because bound methods compare equal if their objects do
+            patch.users -= 1
+            if not patch.users:
+                setattr(obj, attr, patch.original)
+                del _patches[key]
@@ -0,0 +1,326 @@
+"""
+Probabilistic sensitivity analysis over parset uncertainty
+
+The reductions in infections and deaths from an optimized allocation are point estimates for the
+best-estimate parameters. :func:`run_psa` draws perturbed parsets from the uncertainty (the ``sigma``
+of each databook time series), runs each sample through a set of program instructions - typically the
+unoptimized and optimized allocations - on a process pool, and summarises the spread of the results.
+
+Full results are never sent back from the workers. Each worker reduces its sample to the indicators of a
+report specification (see :mod:`cascade_analyses.indicators`) and, optionally, the values of the cascade
+stages, which are a few numbers per scenario and year. These are added to a :class:`SampleSummary` as each
+sample arrives, so memory does not grow with the size of the model. Because the reductions relative to the
+first scenario are computed for each sample, their confidence bands account for the correlation between
+scenarios that share the same parameters.
+
+Typical usage::
+
+    scenarios = sc.odict([("unoptimized", instructions), ("optimized", optimized_instructions)])
+    psa = run_psa(P, scenarios, n_samples=200, report=report_spec, cascade="HIV care cascade", cascade_years=[2022], workers=8)
+    print(psa.summary())
+
+Databooks without uncertainty values give identical samples. ``default_cv`` assigns a standard deviation
+proportional to the value to every time series that does not have one.
+
+"""
+
+import numpy as np
+import atomica as at
+import sciris as sc
+from atomica.model import BadInitialization
+
+from .indicators import evaluate_indicators
+from .parallel import make_pool, worker_data, strip_results, n_workers
+from .system import logger
+from .years import YearIndex
+
+__all__ = ["SampleSummary", "PSAResult", "run_psa"]
+
+
+class SampleSummary:
+    """
+    Accumulate samples of an array
+
+    Samples are added one at a time. Only the arrays being summarised are kept - one row per sample - so the
+    mean and any quantile can be computed at the end.
+
+    :param n_samples: Maximum number of samples
+    :param shape: Shape of each sample
+
+    """
+
+    def __init__(self, n_samples: int, shape: tuple):
+        self.values = np.full((n_samples,) + tuple(shape), np.nan)  #: Array (sample, ...) - rows after :attr:`n` are unused
+        self.n = 0  #: Number of samples added
+
+    def __repr__(self):
+        return f"<SampleSummary {self.n} samples of shape {self.values.shape[1:]}>"
+
+    def add(self, values) -> None:
+        """
+        Add one sample
+
+        :param values: Array with the shape given when the summary was created
+
+        """
+
+        self.values[self.n] = values
+        self.n += 1
+
+    @property
+    def samples(self) -> np.ndarray:
+        """
+        Array (sample, ...) containing the samples added so far
+
+        """
+
+        return self.values[: self.n]
+
+    def mean(self) -> np.ndarray:
+        """
+        Return the mean over samples
+
+        """
+
+        return np.mean(self.samples, axis=0)
+
+    def quantile(self, q) -> np.ndarray:
+        """
+        Return quantiles over samples
+
+        :param q: A quantile or list of quantiles between 0 and 1
+        :return: Array with the quantiles in the first axis (if ``q`` is a list) followed by the shape of each sample
+
+        """
+
+        return np.quantile(self.samples, q, axis=0)
+
+
+class PSAResult:
+    """
+    Summary of a probabilistic sensitivity analysis
+
+    Returned by :func:`run_psa`.
+
+    :param names: Scenario names
+    :param n_samples: Number of samples requested
+    :param quantiles: Quantiles to report. The first and last are the lower and upper bounds of the bands
+    :param years: Labels of the report years
+    :param indicators: Labels of the report indicators
+    :param summed: For each indicator, True if its values are summed over years (so that a total is reported)
+    :param stages: Names of the cascade stages
+    :param cascade_years: Years for the cascade stages
+
+    """
+
+    def __init__(self, names: list, n_samples: int, quantiles: list, years: list = None, indicators: list = None, summed: list = None, stages: list = None, cascade_years: list = None):
+        self.names = list(names)
+        self.quantiles = list(quantiles)
+        self.years = list(years or [])
+        self.indicators = list(indicators or [])
+        self.summed = list(summed or [])
+        self.stages = list(stages or [])
+        self.cascade_years = list(sc.promotetolist(cascade_years))
+        self.n_failed = 0  #: Number of samples that could not be initialized within the maximum number of attempts
+        self.values = SampleSummary(n_samples, (len(self.indicators), len(self.names), len(self.years))) if self.indicators else None  #: Indicators, shape (indicator, scenario, year)
+        self.cascade = SampleSummary(n_samples, (len(self.names), len(self.stages), len(self.cascade_years))) if self.stages else None  #: Cascade stages, shape (scenario, stage, year)
+
+    def __repr__(self):
+        n = self.values.n if self.values is not None else self.cascade.n if self.cascade is not None else 0
+        return f"<PSAResult {n} samples of {len(self.names)} scenarios>"
+
+    def totals(self) -> np.ndarray:
+        """
+        Return the total over years of each indicator, for each sample
+
+        :return: Array (sample, indicator, scenario). Indicators that are not summed over years are NaN
+
+        """
+
+        totals = self.values.samples.sum(axis=-1)
+        totals[:, ~np.array(self.summed, dtype=bool)] = np.nan
+        return totals
+
+    def reductions(self) -> tuple:
+        """
+        Return the relative reduction in each indicator compared to the first scenario, for each sample
+
+        :return: Tuple of arrays ``(by_year, total)`` with shapes (sample, indicator, scenario, year) and
+                 (sample, indicator, scenario). The first scenario is always zero
+
+        """
+
+        values = self.values.samples
+        totals = self.totals()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            by_year = (values[:, :, :1] - values) / values[:, :, :1]
+            total = (totals[:, :, :1] - totals) / totals[:, :, :1]
+        return by_year, total
+
+    def summary(self) -> str:
+        """
+        Return a table of means and bands
+
+        Each entry is the mean followed by the lowest and highest of :attr:`quantiles` in brackets.
+
+        :return: Multi-line string
+
+        """
+
+        lo, hi = self.quantiles[0], self.quantiles[-1]
+
+        def fmt(x) -> str:
+            return "%s (%s-%s)" % tuple("%.4g" % v for v in (np.mean(x), np.quantile(x, lo), np.quantile(x, hi)))
+
+        width = 32
+        lines = []
+
+        if self.values is not None:
+            lines.append(f"{self.values.n} samples - mean ({lo:g}-{hi:g} quantiles)")
+            has_total = any(self.summed)
+            lines.append(" " * width + "".join("%28s" % x for x in self.years) + ("%28s" % "Total" if has_total else ""))
+            values = self.values.samples
+            totals = self.totals()
+            red_year, red_total = self.reductions()
+            for i, label in enumerate(self.indicators):
+                lines.append(label)
+                rows = [(name, values[:, i, j], totals[:, i, j]) for j, name in enumerate(self.names)]
+                rows += [(f"reduction ({name})", red_year[:, i, j], red_total[:, i, j]) for j, name in enumerate(self.names) if j > 0]
+                for name, by_year, total in rows:
+                    line = "  %-*s" % (width - 2, name[: width - 2]) + "".join("%28s" % fmt(by_year[:, k]) for k in range(len(self.years)))
+                    if self.summed[i]:
+                        line += "%28s" % fmt(total)
+                    lines.append(line)
+
+        if self.cascade is not None:
+            lines.append(f"Cascade - {self.cascade.n} samples - mean ({lo:g}-{hi:g} quantiles)")
+            lines.append(" " * width + "".join("%28s" % x for x in self.cascade_years))
+            samples = self.cascade.samples
+            for j, name in enumerate(self.names):
+                lines.append(name)
+                for k, stage in enumerate(self.stages):
+                    lines.append("  %-*s" % (width - 2, stage[: width - 2]) + "".join("%28s" % fmt(samples[:, j, k, m]) for m in range(len(self.cascade_years))))
+
+        if self.n_failed:
+            lines.append(f"{self.n_failed} samples failed to initialize and were excluded")
+        return "\n".join(lines)
+
+
+def _with_default_sigma(parset: at.ParameterSet, cv: float) -> at.ParameterSet:
+    # Return a copy of the parset where every time series without an uncertainty has a standard deviation of cv times its magnitude
+    new = sc.dcp(parset)
+    for par in new.all_pars():
+        for ts in par.ts.values():
+            if ts.sigma is None and ts.has_data:
+                vals = [x for x in list(ts.vals) + [ts.assumption] if x is not None]
+                ts.sigma = cv * float(np.mean(np.abs(vals))) if vals else None
+    return new
+
+
+def _sample_one(project, parset, progset, instructions, names, report, cascade, cascade_years, pops, sample_progset, max_attempts, seed) -> dict:
+    # Run one sample of every scenario and reduce the results to the indicators and cascade values - shared by the serial and parallel code paths
+    np.random.seed(seed)  # Atomica samples with the global generator. Seeding per sample makes results independent of how samples are distributed
+    for _ in range(max_attempts):
+        sampled_parset = parset.sample()
+        sampled_progset = progset.sample() if sample_progset and progset is not None else progset
+        try:
+            results = [project.run_sim(parset=sampled_parset, progset=sampled_progset if instr is not None else None, progset_instructions=instr, result_name=name) for instr, name in zip(instructions, names)]
+            break
+        except BadInitialization:
+            continue
+    else:
+        return None
+
+    out = {}
+    if report:
+        _, values = evaluate_indicators(results, report)
+        out["values"] = np.stack(list(values.values()))  # Array (indicator, scenario, year)
+    if cascade is not None:
+        stages = [at.get_cascade_vals(x, cascade, pops=pops, year=cascade_years)[0] for x in results]
+        out["stages"] = list(stages[0].keys())
+        out["cascade"] = np.array([list(x.values()) for x in stages])  # Array (scenario, stage, year)
+    return out
+
+
+def _run_sample(seed: int) -> dict:
+    data = worker_data()
+    return _sample_one(data["project"], data["parset"], data["progset"], seed=seed, **data["args"])
+
+
+def run_psa(project: at.Project, instructions, n_samples: int, parset="default", progset="default", report: dict = None, cascade=None, cascade_years=None, pops="all", default_cv: float = None, sample_progset: bool = False, quantiles: list = None, seed: int = None, max_attempts: int = 50, workers: int = None) -> PSAResult:
+    """
+    Run a probabilistic sensitivity analysis
+
+    :param project: The :class:`Project` to simulate
+    :param instructions: An ``sc.odict`` of :class:`ProgramInstructions` keyed by scenario name. A ``None`` entry runs the
+                         parset without programs. Reductions are reported relative to the first scenario
+    :param n_samples: Number of parset samples. Every scenario is run with each sample
+    :param parset: Name of the parset to sample from (or a :class:`ParameterSet` instance)
+    :param progset: Name of the progset to use (or a :class:`ProgramSet` instance)
+    :param report: Report specification with the indicators to summarise (see :mod:`cascade_analyses.indicators`)
+    :param cascade: Optionally specify a cascade, to also summarise the value of each of its stages
+    :param cascade_years: Years to report the cascade stages in
+    :param pops: Populations to aggregate the cascade over
+    :param default_cv: If provided, time series without an uncertainty in the databook are given a standard deviation of
+                       ``default_cv`` times the magnitude of their values
+    :param sample_progset: If True, also sample the progset (e.g. unit costs) in each sample
+    :param quantiles: Quantiles to report. By default, ``[0.025, 0.5, 0.975]``
+    :param seed: Random seed. Sample ``i`` uses the seed ``seed + i``, so the samples are the same for any number of workers
+    :param max_attempts: Number of times a sample is redrawn if it gives a bad initialization, before it is excluded
+    :param workers: Number of worker processes. If ``None``, use one per CPU (up to the number of samples). With 1 worker, samples are run in this process
+    :return: A :class:`PSAResult`
+
+    """
+
+    if report is None and cascade is None:
+        raise Exception("A report specification and/or cascade must be provided to summarise the samples")
+    if cascade is not None and cascade_years is None:
+        raise Exception("cascade_years must be specified to summarise the cascade")
+    if isinstance(instructions, dict):
+        names, instructions = list(instructions.keys()), list(instructions.values())
+    else:
+        instructions = sc.promotetolist(instructions, keepnone=True)
+        names = [f"scenario_{i}" for i in range(len(instructions))]
+
+    parset = project.parset(parset)
+    if default_cv:
+        parset = _with_default_sigma(parset, default_cv)
+    progset = project.progset(progset) if any(x is not None for x in instructions) else None
+    seed = int(np.random.randint(2**31 - n_samples)) if seed is None else seed
+    args = dict(instructions=instructions, names=names, report=report, cascade=cascade, cascade_years=cascade_years, pops=pops, sample_progset=sample_progset, max_attempts=max_attempts)
+
+    if report:
+        years = YearIndex(project.settings.tvec, report["years"]).labels
+        summed = [x.get("aggregate") == "sum" for x in report["indicators"].values()]
+        psa = PSAResult(names, n_samples, quantiles or [0.025, 0.5, 0.975], years=years, indicators=list(report["indicators"].keys()), summed=summed, cascade_years=cascade_years)
+    else:
+        psa = PSAResult(names, n_samples, quantiles or [0.025, 0.5, 0.975], cascade_years=cascade_years)
+
+    def add(sample):
+        if sample is None:
+            psa.n_failed += 1
+            return
+        if "values" in sample:
+            psa.values.add(sample["values"])
+        if "cascade" in sample:
+            if psa.cascade is None:
+                psa.stages = sample["stages"]
+                psa.cascade = SampleSummary(n_samples, sample["cascade"].shape)
+            psa.cascade.add(sample["cascade"])
+
+    workers = n_workers(workers, n_samples)
+    seeds = range(seed, seed + n_samples)
+    tm = sc.tic()
+    if workers == 1:
+        state = np.random.get_state()  # Each sample reseeds the global generator, which is restored for the caller afterwards
+        try:
+            for x in seeds:
+                add(_sample_one(project, parset, progset, seed=x, **args))
+        finally:
+            np.random.set_state(state)
+    else:
+        with make_pool(workers, project=strip_results(project), parset=parset, progset=progset, args=args) as pool:
+            for sample in pool.map(_run_sample, seeds):
+                add(sample)
+    logger.info("Ran %d samples of %d scenarios with %d worker(s) in %.2fs (%d failed)", n_samples, len(names), workers, sc.toc(tm, output=True), psa.n_failed)
+    return psa
@@ -0,0 +1,230 @@
+"""
+Warm-started simulations from the program start year
+
+Programs only change a simulation from ``ProgramInstructions.start_year`` onward, but every run with
+programs integrates the whole timeline from ``sim_start``. In the T2DM optimization, for example, 2014-2018
+is re-simulated identically for every candidate allocation. A :class:`Checkpoint` stores the model state at
+the last timestep before programs start, computed once per parset, progset and start year. Simulations then
+resume from a copy of that state, so only the years from the program start onward are integrated.
+
+Typical usage::
+
+    checkpoint = Checkpoint(P, 2019, parset="default", progset="default")
+    result = checkpoint.run(at.ProgramInstructions(start_year=2019, alloc=alloc), name="scenario")
+
+    with WarmStart():  # Every objective evaluation in at.optimize() resumes from a checkpoint
+        optimized_instructions = at.optimize(P, optimization, parset=parset, progset=progset, instructions=instructions)
+
+Results are identical to a full run, because the steps before the checkpoint do not depend on the program
+instructions. The integration loop itself is Atomica's (``Model.process()``), split at the checkpoint, so this
+module needs to be kept in step with it if that changes. If programs start at or before ``sim_start``, there is
+nothing to skip and the full simulation is run.
+
+"""
+
+import pickle
+import threading
+from collections import OrderedDict
+
+import atomica as at
+import atomica.optimization
+import numpy as np
+import sciris as sc
+
+from .system import logger, patched
+
+__all__ = ["Checkpoint", "WarmStart"]
+
+
+def _advance(model: at.Model, index: int) -> None:
+    # Integrate an unprocessed model up to and including timestep `index` without programs - the first part of Model.process()
+    if model._t_index != 0:
+        raise Exception("Can only create a checkpoint from a model that has not been processed")
+    model._set_exec_order()
+    model.programs_active = False  # Programs have no effect before the checkpoint
+    model.update_pars()
+    model.flush_junctions()
+    model.update_pars()
+    model.update_links()
+    while model._t_index < index:
+        model._t_index += 1
+        model.update_comps()
+        model.update_pars()
+        model.update_links()
+
+
+def _resume(model: at.Model) -> None:
+    # Activate programs and integrate the rest of the simulation - the remainder of Model.process()
+    model._set_exec_order()  # Not preserved when the model is pickled
+    model._update_program_cache()
+    while model._t_index < (model.t.size - 1):
+        model._t_index += 1
+        model.update_comps()
+        model.update_pars()
+        model.update_links()
+
+    for par_name in model._exec_order["all_pars"]:
+        for par in model._vars_by_pop[par_name]:
+            if par.fcn_str and not (par._is_dynamic or par._precompute):
+                par.update()
+                par.constrain()
+    for pop in model.pops:
+        for charac in pop.characs:
+            charac._vals = None
+    model._program_cache = None
+
+
+class Checkpoint:
+    """
+    Model state at the last timestep before programs start
+
+    :param project: The :class:`Project`, whose settings and framework are used
+    :param start_year: Year that programs start. The checkpoint can be used for any instructions that start in or after this year
+    :param parset: Name of the parset to use (or a :class:`ParameterSet` instance)
+    :param progset: Name of the progset to use (or a :class:`ProgramSet` instance)
+
+    """
+
+    def __init__(self, project: at.Project, start_year: float, parset="default", progset="default"):
+        self.parset = project.parset(parset)
+        model = at.Model(project.settings, project.framework, self.parset, project.progset(progset), at.ProgramInstructions(start_year=start_year))
+        self._set_model(model)
+
+    @classmethod
+    def from_model(cls, model: at.Model, parset: at.ParameterSet = None):
+        """
+        Make a checkpoint from a model that has been built but not processed
+
+        The checkpoint is taken before the start year of ``model.program_instructions``. The model is modified in place.
+
+        :param model: An unprocessed :class:`Model`
+        :param parset: The :class:`ParameterSet` the model was built from, for the results
+        :return: A new :class:`Checkpoint`
+
+        """
+
+        self = cls.__new__(cls)
+        self.parset = parset
+        self._set_model(model)
+        return self
+
+    def _set_model(self, model: at.Model) -> None:
+        start_year = model.program_instructions.start_year if model.program_instructions is not None else np.inf
+        self.start_year = start_year
+        self.index = int(np.sum(model.t < start_year)) - 1  #: Index of the last timestep before programs start, or -1 if programs start at the beginning
+        if self.index >= 0:
+            _advance(model, self.index)
+        self._pickled = pickle.dumps(model)  # Unpickling is a fast deep copy
+        self.t = model.t
+
+    def __repr__(self):
+        if self.index < 0:
+            return f"<Checkpoint before {self.start_year:g} - programs start at the beginning, so nothing is skipped>"
+        return f"<Checkpoint at {self.t[self.index]:g}, skipping {self.index + 1} of {len(self.t)} timesteps>"
+
+    def model(self) -> at.Model:
+        """
+        Return a copy of the model at the checkpoint
+
+        :return: A :class:`Model` that can be passed to :meth:`resume`, after optionally modifying its ``program_instructions``
+
+        """
+
+        return pickle.loads(self._pickled)
+
+    def resume(self, model: at.Model) -> None:
+        """
+        Finish a simulation from the checkpoint
+
+        :param model: A model returned by :meth:`model`. It is processed in place
+
+        """
+
+        if self.index < 0:
+            model.process()
+            return
+        instructions = model.program_instructions
+        if instructions is not None and instructions.start_year <= model.t[self.index]:
+            raise Exception(f"Programs start in {instructions.start_year:g}, which is before the checkpoint at {model.t[self.index]:g}")
+        _resume(model)
+
+    def run(self, instructions: at.ProgramInstructions, name: str = None) -> at.Result:
+        """
+        Run a simulation from the checkpoint
+
+        :param instructions: The :class:`ProgramInstructions` to use. They must start in or after :attr:`start_year`
+        :param name: Name of the result
+        :return: A :class:`Result`, identical to ``Project.run_sim()`` with the same parset, progset and instructions
+
+        """
+
+        model = self.model()
+        model.program_instructions = sc.dcp(instructions)
+        self.resume(model)
+        return at.Result(model=model, parset=self.parset, name=name)
+
+
+class WarmStart:
+    """
+    Warm-start objective evaluations in ``at.optimize()``
+
+    While active, objective evaluations in ``atomica.optimization`` made by the thread that entered it resume
+    from a :class:`Checkpoint` of the model being optimized. Other threads are not affected. A checkpoint is
+    made the first time each model is seen. This can be combined with an :class:`EvaluationCache`, which
+    should be entered afterwards so that it only calls the warm-started objective on a cache miss.
+
+    :param maxsize: Maximum number of checkpoints to keep - one is needed for each ``at.optimize()`` call running at the same time
+
+    """
+
+    def __init__(self, maxsize: int = 4):
+        self.maxsize = maxsize
+        self._checkpoints = OrderedDict()  # Maps id(pickled_model) to (pickled_model, checkpoint) - holding the bytes ensures the id is not reused
+        self._lock = threading.Lock()
+        self._active = 0  # Number of threads in which it is active
+        self._local = threading.local()  # The patch installed by each thread
+
+    def __repr__(self):
+        return f"<WarmStart with {len(self._checkpoints)} checkpoint(s)>"
+
+    def _checkpoint(self, pickled_model: bytes) -> Checkpoint:
+        key = id(pickled_model)
+        with self._lock:
+            if key in self._checkpoints and self._checkpoints[key][0] is pickled_model:
+                return self._checkpoints[key][1]
+        checkpoint = Checkpoint.from_model(pickle.loads(pickled_model))
+        logger.debug("Created %s", checkpoint)
+        with self._lock:
+            self._checkpoints[key] = (pickled_model, checkpoint)
+            if len(self._checkpoints) > self.maxsize:
+                self._checkpoints.popitem(last=False)
+        return checkpoint
+
+    def _objective(self, objective, x, pickled_model, optimization, hard_constraints, baselines):
+        # Same as atomica.optimization._objective_fcn, except that the model is resumed from the checkpoint
+        checkpoint = self._checkpoint(pickled_model)
+        try:
+            model = checkpoint.model()
+            optimization.update_instructions(x, model.program_instructions)
+            optimization.constrain_instructions(model.program_instructions, hard_constraints)
+            checkpoint.resume(model)
+        except at.FailedConstraint:
+            return np.inf
+        return optimization.compute_objective(model, baselines)
+
+    def __enter__(self):
+        if getattr(self._local, "patch", None) is not None:
+            raise Exception("This WarmStart is already active in this thread")
+        with self._lock:
+            self._active += 1
+        self._local.patch = patched(atomica.optimization, "_objective_fcn", self._objective)
+        self._local.patch.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self._local.patch.__exit__(None, None, None)
+        self._local.patch = None
+        with self._lock:
+            self._active -= 1
+            if not self._active:
+                self._checkpoints.clear()
@@ -0,0 +1,112 @@
+"""
+Aggregation of results over years
+
+Picking out years with hard-coded timestep indices (e.g. ``vals[[8, 12, 16]]``) is only correct for one
+``sim_start`` and ``sim_dt``. :class:`YearIndex` instead precomputes, for a vector of simulation times, the
+index of each time point and a weight matrix mapping time points to year bins. Aggregating any array with
+time as its last axis - a single variable, or many variables, populations and results at once - is then
+a single masked sum, and stays correct if the simulation settings change. A NaN only affects the bins that
+contain its time point.
+
+Typical usage::
+
+    store = ResultStore.from_result(result, variables=["num_acq", "num_hiv_deaths"])
+    years = YearIndex(store.t, range(2017, 2023))  # Calendar years 2017-2022
+    years.sum(store.get(), annualise=True)  # Array (variable, population, year) with the number in each year
+    years.at(store.total("num_acq"), [2020, 2025])  # Values at the start of 2020 and 2025
+
+For quantities in annual units (e.g. 'Annual number of new HIV infections'), the total over a bin is the sum
+of the values multiplied by the timestep, which is what ``sum(..., annualise=True)`` returns. For quantities
+that are already per timestep (e.g. link flows), use ``sum()`` without annualising.
+
+"""
+
+import numpy as np
+import sciris as sc
+
+__all__ = ["YearIndex"]
+
+
+class YearIndex:
+    """
+    Map simulation times to year bins
+
+    :param t: Array of simulation times, e.g. ``result.t`` or ``store.t``
+    :param bins: A list of years, each of which is a bin from the start of that year to the start of the next, or
+                 a list of ``(start, end)`` tuples, each of which is the bin ``start <= t < end``
+
+    """
+
+    def __init__(self, t, bins):
+        self.t = np.asarray(t, dtype=float)
+        self.dt = float(np.diff(self.t).mean()) if len(self.t) > 1 else 1.0
+        self.bins = [tuple(x) if isinstance(x, (tuple, list)) else (x, x + 1) for x in bins]
+        self.labels = [f"{start:g}" if end == start + 1 else f"{start:g}-{end:g}" for start, end in self.bins]  #: Text label for each bin
+        self.index = {round(x, 6): i for i, x in enumerate(self.t)}  #: Maps simulation time to index
+
+        starts = np.array([x[0] for x in self.bins], dtype=float)[:, None]
+        ends = np.array([x[1] for x in self.bins], dtype=float)[:, None]
+        tol = 1e-6 * self.dt  # So that floating point times at bin edges are placed in the right bin
+        self.weights = ((self.t >= starts - tol) & (self.t < ends - tol)).astype(float)  #: Array (bin, time) that is 1 where a time is in a bin
+        self.counts = self.weights.sum(axis=1)  #: Number of time points in each bin
+        self._columns = np.nonzero(self.weights.any(axis=0))[0]  # Time points that are in at least one bin
+        self._mask = self.weights[:, self._columns].astype(bool)  # Array (bin, time) for those time points
+        if any(self.counts == 0):
+            empty = [self.labels[i] for i in np.nonzero(self.counts == 0)[0]]
+            raise Exception(f"Year bins {empty} do not contain any simulation time points (simulation runs from {self.t[0]} to {self.t[-1]})")
+
+    def __repr__(self):
+        return f"<YearIndex {len(self.bins)} bins from {self.labels[0]} to {self.labels[-1]}, dt={self.dt:g}>"
+
+    def sum(self, values, annualise: bool = False) -> np.ndarray:
+        """
+        Sum values over each bin
+
+        :param values: Array with time as its last axis
+        :param annualise: If True, multiply by the timestep, converting values in annual units into totals over each bin
+        :return: Array with the same leading axes as ``values`` and one entry per bin in the last axis
+
+        """
+
+        values = np.asarray(values)[..., None, self._columns]  # Add a bin axis before the time axis
+        out = np.where(self._mask, values, 0).sum(axis=-1)  # Not a matrix product, where 0 * NaN would spread a NaN to every bin
+        return out * self.dt if annualise else out
+
+    def mean(self, values) -> np.ndarray:
+        """
+        Average values over each bin
+
+        :param values: Array with time as its last axis
+        :return: Array with the same leading axes as ``values`` and one entry per bin in the last axis
+
+        """
+
+        return self.sum(values) / self.counts
+
+    def at(self, values, years) -> np.ndarray:
+        """
+        Return values at specific times
+
+        :param values: Array with time as its last axis
+        :param years: A time or list of times, each of which must be a simulation time point
+        :return: Array with the same leading axes as ``values`` and one entry per year in the last axis (or no last axis for a single year)
+
+        """
+
+        return np.asarray(values)[..., self.indices(years)]
+
+    def indices(self, years):
+        """
+        Return the indices of simulation time points
+
+        :param years: A time or list of times, each of which must be a simulation time point
+        :return: The index of the time (or an array of indices)
+
+        """
+
+        try:
+            if sc.isnumber(years):
+                return self.index[round(float(years), 6)]
+            return np.array([self.index[round(float(x), 6)] for x in years], dtype=int)
+        except KeyError as E:
+            raise Exception(f"Year {E} is not a simulation time point (dt={self.dt:g})") from None
@@ -0,0 +1,20 @@
+"""
+Script to analyse the hypertension care cascade in Malawi
+
+The analysis (inputs, simulation settings and the settings for each stage) is defined in hypertension_malawi.json.
+Stages and options can be given on the command line, otherwise the "targets" in hypertension_malawi.json are run, e.g.
+
+    python hypertension_malawi.py budget_scenarios optimize --no-plots
+
+Run ``python hypertension_malawi.py --help`` for all of the options.
+"""
+
+## IMPORTS
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))  # Repository root, for cascade_analyses
+from cascade_analyses import cli
+
+## BEGIN ANALYSES
+if __name__ == "__main__":
+    sys.exit(cli.main([os.path.join(os.path.dirname(os.path.abspath(__file__)), "hypertension_malawi.json")] + sys.argv[1:]))